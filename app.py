@@ -1,32 +1,64 @@
 import streamlit as st
 import os
 import datetime
-import smtplib
-from email.mime.text import MIMEText
 
-from auth import login_screen, BRANCHES
+import fileserver
+import ingest
+import instrument
+import mailer
+import roster
+import sessions
+import slowlog
+import writer
+from thumbnails import avatar, make_thumbnails, validate_image
+from auth import login_screen, set_session_cookie, BRANCHES
 from db import (
-    get_db,
-    add_task, get_tasks, update_task, delete_task,
+    close_db,
+    add_task, get_tasks, get_tasks_for_student, update_task, delete_task,
     mark_completed,
-    mark_attendance, get_attendance, get_attendance_report,
-    get_all_users,
-    get_performance,
-    add_library_item, get_library_items, delete_library_item,
-    hash_password
+    save_submission, get_student_submissions, get_submissions, count_submissions,
+    mark_attendance_bulk, get_attendance_bitmap, get_attendance_report,
+    get_students, search_users, update_profile, update_user,
+    get_performance, get_task_completion_stats, get_branch_completion_stats,
+    add_library_item, get_library_items, search_library, delete_library_item, put_blob,
+    get_ingest_status, enqueue_email, get_outbox_stats, get_pool_stats,
 )
+from cache import cache_stats
 
 st.set_page_config(page_title="Todo Planner", page_icon="📚", layout="wide")
 
 # ------------ CLOUD SAFE SECRETS ------------
 EMAIL_USER = st.secrets.get("EMAIL_USER")
 EMAIL_PASS = st.secrets.get("EMAIL_PASS")
+SMTP_HOST = st.secrets.get("SMTP_HOST")
+SMTP_PORT = st.secrets.get("SMTP_PORT", 465)
+SMTP_SSL = str(st.secrets.get("SMTP_SSL", "true")).lower() not in ("0", "false", "no")
+FILES_PUBLIC_URL = st.secrets.get("FILES_PUBLIC_URL")
+FILES_PORT = st.secrets.get("FILES_PORT", 8502)
+DIAGNOSTICS = str(st.secrets.get("DIAGNOSTICS", "false")).lower() in ("1", "true", "yes")
+METRICS_FILE = st.secrets.get("METRICS_FILE")
 
 
 # ------------ DIRECTORIES ------------
-os.makedirs("submissions", exist_ok=True)
-os.makedirs("library_files", exist_ok=True)
-os.makedirs("profile_photos", exist_ok=True)
+# New uploads go to the content-addressed store in blobs/ (storage.py);
+# the old folders still hold files from earlier versions.
+os.makedirs("blobs", exist_ok=True)
+
+# Background workers run once per process; later reruns are no-ops.
+ingest.start_worker()
+
+if SMTP_HOST or (EMAIL_USER and EMAIL_PASS):
+    mailer.start_dispatcher(
+        SMTP_HOST or "smtp.gmail.com", SMTP_PORT,
+        EMAIL_USER, EMAIL_PASS, use_ssl=SMTP_SSL,
+        sender=EMAIL_USER or "noreply@localhost"
+    )
+
+if FILES_PUBLIC_URL:
+    fileserver.start_server("0.0.0.0", FILES_PORT, FILES_PUBLIC_URL)
+
+if METRICS_FILE:
+    instrument.start_exporter(METRICS_FILE)
 
 
 def init():
@@ -35,6 +67,25 @@ def init():
     if "view" not in st.session_state:
         st.session_state.view = "Dashboard"
 
+    # Links from older versions carried the token in the URL
+    if "session" in st.query_params:
+        del st.query_params["session"]
+
+    # Restore a login after a browser refresh or worker restart. The cookie
+    # is read once per browser session (st.context holds the value sent at
+    # connect time) and swapped for a fresh token.
+    cookie = st.context.cookies.get(sessions.COOKIE_NAME)
+    if cookie and not st.session_state.get("cookie_checked"):
+        st.session_state.cookie_checked = True
+        user = sessions.resume_session(cookie)
+        if user and st.session_state.current_user is None:
+            st.session_state.current_user = user
+            st.session_state.session_token = sessions.rotate_session(cookie, user)
+
+    token = st.session_state.get("session_token")
+    if token != cookie:
+        set_session_cookie(token)
+
 init()
 
 # ------------ BASIC CSS ------------
@@ -50,46 +101,44 @@ section[data-testid="stSidebar"] div[data-testid="stButton"] {margin-bottom:2px
 
 
 # ------------ EMAIL SENDER ------------
+# Messages go to the outbox table and are delivered by the mailer thread.
+# Without an SMTP account nothing would ever send them, so skip queueing.
 def send_email(to, subject, message):
-    if not EMAIL_USER or not EMAIL_PASS:
+    if not mailer.enabled():
         return
-    msg = MIMEText(message)
-    msg["Subject"], msg["From"], msg["To"] = subject, EMAIL_USER, to
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-        server.login(EMAIL_USER, EMAIL_PASS)
-        server.sendmail(EMAIL_USER, to, msg.as_string())
+    enqueue_email(to, subject, message)
+    mailer.notify()
 
 
 # ------------ PROFILE ------------
 def profile_page():
     user = st.session_state.current_user
-    conn = get_db()
 
     st.subheader("My Profile")
 
-    if user.get("photo_path"):
-        st.image(user["photo_path"], width=140)
+    photo_thumb = avatar(user, 140) or user.get("photo_path")
+    if photo_thumb:
+        st.image(photo_thumb, width=140)
 
     name = st.text_input("Full Name", user["name"])
     phone = st.text_input("Mobile", user.get("phone", ""))
     dob = st.text_input("Date of Birth", user.get("dob", ""))
 
     photo = st.file_uploader("Change Photo", type=["png","jpg","jpeg"])
-    photo_path = user.get("photo_path")
-
-    if photo:
-        save = f"profile_photos/{user['email']}.png"
-        with open(save, "wb") as f:
-            f.write(photo.read())
-        photo_path = save
+    photo_path, photo_sha = user.get("photo_path"), None
 
     if st.button("Save Profile"):
-        conn.execute(
-            "UPDATE users SET name=?, phone=?, dob=?, photo_path=? WHERE id=?",
-            (name, phone, dob, photo_path, user["id"])
-        )
-        conn.commit()
-        user.update({"name": name, "phone": phone, "dob": dob, "photo_path": photo_path})
+        if photo:
+            try:
+                validate_image(photo)
+            except ValueError as e:
+                st.error(str(e))
+                return
+            photo_sha, _, photo_path = put_blob(photo)
+            make_thumbnails(photo_path, photo_sha)
+        update_profile(user["id"], name, phone, dob, photo_path, photo_sha)
+        user.update({"name": name, "phone": phone, "dob": dob, "photo_path": photo_path,
+                     "photo_sha": photo_sha or user.get("photo_sha")})
         st.success("Profile updated")
         st.rerun()
 
@@ -97,7 +146,6 @@ def profile_page():
 # ------------ DASHBOARD ------------
 def dashboard():
     user = st.session_state.current_user
-    conn = get_db()
 
     st.subheader("Tasks")
 
@@ -108,9 +156,7 @@ def dashboard():
         deadline = st.date_input("Deadline")
         assign_type = st.radio("Assign To", ["Student","Branch"])
 
-        students = conn.execute(
-            "SELECT id,name,branch FROM users WHERE role='student'"
-        ).fetchall()
+        students = get_students()
 
         if assign_type == "Student":
             s = st.selectbox(
@@ -124,7 +170,9 @@ def dashboard():
             assigned_to = f"branch:{b}"
 
         if st.button("Assign Task"):
-            add_task(title, desc, str(deadline), assigned_to, user["id"])
+            add_task(title, desc, str(deadline), assigned_to, user["id"],
+                     notify=mailer.enabled())
+            mailer.notify()
             st.success("Task assigned")
 
         st.divider()
@@ -132,131 +180,270 @@ def dashboard():
         # ---- ATTENDANCE MANAGER ----
         st.subheader("Attendance Manager")
 
-        students = conn.execute(
-            "SELECT id, name, branch FROM users WHERE role='student'"
-        ).fetchall()
-
-        students = [dict(s) for s in students]
-
-        selected_student = st.selectbox(
-            "Select student",
-            students,
-            format_func=lambda s: f"{s['name']} — {s['branch']}"
+        a1, a2 = st.columns(2)
+        att_date = a1.date_input(
+            "Date", datetime.date.today(),
+            max_value=datetime.date.today(), key="att_date"
         )
+        # One class at a time: the widget lists (and preselects) only its students
+        att_branch = a2.selectbox("Class / Branch", BRANCHES, index=None,
+                                  placeholder="Choose a class", key="att_branch")
+
+        if att_branch is None:
+            st.info("Choose a class to take attendance.")
+        else:
+            class_students = get_students(att_branch)
+            present = st.multiselect(
+                "Present students",
+                class_students,
+                default=class_students,
+                format_func=lambda s: s["name"],
+                key=f"att_roster_{att_branch}"
+            )
 
-        if st.button("Mark Today's Attendance"):
-            mark_attendance(selected_student["id"])
-            st.success("Attendance recorded")
+            if st.button(f"Mark Attendance ({len(present)})", key="att_mark",
+                         disabled=not present):
+                added = mark_attendance_bulk([s["id"] for s in present], att_date)
+                st.success(f"Attendance recorded for {att_date}: {added} new, "
+                           f"{len(present) - added} already marked")
 
         st.divider()
         st.subheader("All Tasks")
-
-        for t in get_tasks():
-            with st.expander(f"{t['title']} — {t['deadline']}"):
-                et = st.text_input("Edit title", t["title"], key=f"et{t['id']}")
-                ed = st.text_area("Edit desc", t["description"], key=f"ed{t['id']}")
-                dl = st.date_input(
-                    "Edit deadline",
-                    datetime.date.fromisoformat(t["deadline"]),
-                    key=f"dl{t['id']}"
-                )
-
-                if st.button("Save", key=f"s{t['id']}"):
-                    update_task(t["id"], et, ed, str(dl))
-                    st.success("Updated")
-
-                if st.button("Delete", key=f"d{t['id']}"):
-                    delete_task(t["id"])
-                    st.warning("Deleted")
-                    st.rerun()
-
-                if t["pdf_path"]:
-                    with open(t["pdf_path"],"rb") as f:
-                        st.download_button("Download submission", f, key=f"dw{t['id']}")
+        task_list()
 
     # ---- STUDENT ----
     if user["role"] == "student":
-        tasks = [
-            t for t in get_tasks()
-            if t["assigned_to"] == f"student:{user['id']}"
-            or t["assigned_to"] == f"branch:{user['branch']}"
-        ]
+        tasks = get_tasks_for_student(user["id"], user["branch"])
+        submitted = get_student_submissions(user["id"])
 
         for t in tasks:
             with st.expander(f"{t['title']} — {t['deadline']}"):
-                folder = f"submissions/{user['id']}"
-                os.makedirs(folder, exist_ok=True)
+                if t["id"] in submitted:
+                    st.caption(f"Submitted {submitted[t['id']]['uploaded_at'][:16]}")
 
                 upload = st.file_uploader("Upload PDF", type=["pdf"], key=f"u{t['id']}")
-                if upload:
-                    save = f"{folder}/{t['id']}.pdf"
-                    with open(save,"wb") as f:
-                        f.write(upload.read())
-                    conn.execute("UPDATE tasks SET pdf_path=? WHERE id=?", (save,t["id"]))
-                    conn.commit()
+                # The uploader keeps its file across reruns; save each file once.
+                if upload and st.session_state.get(f"saved_u{t['id']}") != upload.file_id:
+                    sha, size, path = put_blob(upload)
+                    save_submission(t["id"], user["id"], path, size, sha)
+                    st.session_state[f"saved_u{t['id']}"] = upload.file_id
                     st.success("Uploaded")
 
                 if st.button("Complete", key=f"c{t['id']}"):
-                    mark_completed(user["id"], t["id"])
-                    st.success("Marked complete")
+                    if mark_completed(user["id"], t["id"]):
+                        st.success("Marked complete")
+                    else:
+                        st.info("Already marked complete")
 
         st.divider()
 
         # ---- ATTENDANCE VIEW ----
         st.subheader("Attendance (CodeChef Style)")
 
-        records = get_attendance(user["id"])
-        attended = {r["date"] for r in records}
+        start_date, bitmap = get_attendance_bitmap(user["id"], ATTENDANCE_DAYS)
 
-        today = datetime.date.today()
-        start_date = today - datetime.timedelta(days=365)
+        st.write("Last 12 months")
+        st.markdown(attendance_heatmap(start_date, bitmap), unsafe_allow_html=True)
 
-        days = []
-        d = start_date
-        while d <= today:
-            days.append(d)
-            d += datetime.timedelta(days=1)
+        percent = round((bitmap.bit_count() / ATTENDANCE_DAYS) * 100, 1)
+        st.metric("Attendance (Year)", f"{percent}%")
 
-        st.write("Last 12 months")
 
-        cols = st.columns(53)
+# ------------ ATTENDANCE HEATMAP ------------
+ATTENDANCE_DAYS = 366
+CELL, GAP = 14, 4
 
-        for i, col in enumerate(cols):
-            with col:
-                week_days = days[i*7:(i+1)*7]
-                for wd in week_days:
-                    iso = wd.isoformat()
 
-                    style = (
-                        "background-color:#2e7d32;"
-                        if iso in attended
-                        else "background-color:#d7d7d7;"
-                    )
+def attendance_heatmap(start_date, bitmap, days=ATTENDANCE_DAYS):
+    # One column per 7 consecutive days, drawn as a single SVG.
+    weeks = -(-days // 7)
+    width, height = weeks * (CELL + GAP), 7 * (CELL + GAP)
+    cells = []
+    for i in range(days):
+        color = "#2e7d32" if bitmap >> i & 1 else "#d7d7d7"
+        day = start_date + datetime.timedelta(days=i)
+        x, y = (i // 7) * (CELL + GAP), (i % 7) * (CELL + GAP)
+        cells.append(
+            f"<rect x='{x}' y='{y}' width='{CELL}' height='{CELL}' rx='3' "
+            f"fill='{color}'><title>{day.isoformat()}</title></rect>"
+        )
+    return (
+        f"<svg width='{width}' height='{height}' viewBox='0 0 {width} {height}' "
+        f"style='max-width:100%;height:auto'>{''.join(cells)}</svg>"
+    )
 
-                    st.markdown(
-                        f"<div style='{style} width:14px; height:14px; border-radius:3px; margin:2px;'></div>",
-                        unsafe_allow_html=True,
-                    )
 
-        percent = round((len(attended) / 365) * 100, 1)
-        st.metric("Attendance (Year)", f"{percent}%")
+# ------------ KEYSET PAGER ------------
+def keyset_page(name, filters, fetch, page_size, cursor_of, editing=None):
+    # cursors[i] is the cursor_of() the last row shown before page i.
+    # Returns a container placed above the Prev/Next row plus the page's rows.
+    if st.session_state.get(f"{name}_filters") != filters:
+        st.session_state[f"{name}_filters"] = filters
+        st.session_state[f"{name}_cursors"] = [None]
+        if editing:
+            st.session_state[editing] = None
+
+    cursors = st.session_state[f"{name}_cursors"]
+    rows = fetch(cursors[-1], page_size + 1)
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+
+    body = st.container()
+    p1, p2, p3 = st.columns([1, 1, 6])
+    if p1.button("Previous", disabled=len(cursors) == 1, key=f"{name}_prev"):
+        cursors.pop()
+        if editing:
+            st.session_state[editing] = None
+        st.rerun()
+    if p2.button("Next", disabled=not has_next, key=f"{name}_next"):
+        cursors.append(cursor_of(rows[-1]))
+        if editing:
+            st.session_state[editing] = None
+        st.rerun()
+    p3.caption(f"Page {len(cursors)}")
+    return body, rows
+
+
+# ------------ TASK LIST (TEACHER) ------------
+TASK_PAGE_SIZE = 20
+
+
+def task_list():
+    f1, f2 = st.columns(2)
+    search = f1.text_input("Search tasks", key="task_search")
+    branch = f2.selectbox("Assigned branch", ["ALL"] + BRANCHES, key="task_branch")
+    filters = {"search": search or None, "branch": None if branch == "ALL" else branch}
+
+    body, rows = keyset_page(
+        "task", filters,
+        lambda after, limit: get_tasks(after_id=after, limit=limit, **filters),
+        TASK_PAGE_SIZE, lambda t: t["id"], editing="editing_task"
+    )
+    with body:
+        if not rows:
+            st.info("No tasks found.")
+
+        for t in rows:
+            c1, c2, c3 = st.columns([6, 2, 1])
+            c1.write(f"**{t['title']}** — {t['assigned_to']}")
+            c2.write(t["deadline"])
+            c3.button("Edit", key=f"open{t['id']}", on_click=open_task_editor, args=(t["id"],))
+
+            if st.session_state.get("editing_task") == t["id"]:
+                task_editor(t)
+
+
+def open_task_editor(task_id):
+    st.session_state.editing_task = task_id
+
+
+def task_editor(t):
+    with st.container(border=True):
+        et = st.text_input("Edit title", t["title"], key=f"et{t['id']}")
+        ed = st.text_area("Edit desc", t["description"], key=f"ed{t['id']}")
+        dl = st.date_input(
+            "Edit deadline",
+            datetime.date.fromisoformat(t["deadline"]),
+            key=f"dl{t['id']}"
+        )
+
+        b1, b2, b3 = st.columns([1, 1, 6])
+        if b1.button("Save", key=f"s{t['id']}"):
+            update_task(t["id"], et, ed, str(dl))
+            st.success("Updated")
+
+        if b2.button("Delete", key=f"d{t['id']}"):
+            delete_task(t["id"])
+            st.session_state.editing_task = None
+            st.warning("Deleted")
+            st.rerun()
+
+        if b3.button("Close", key=f"x{t['id']}"):
+            st.session_state.editing_task = None
+            st.rerun()
+
+        submissions_view(t)
+
+
+def submissions_view(t):
+    count = count_submissions(t["id"])
+    st.write(f"**Submissions ({count})**")
+    if not count:
+        return
+
+    if st.session_state.get("sub_list") != t["id"]:
+        st.button("Show submissions", key=f"subs{t['id']}",
+                  on_click=prepare_download, args=("sub_list", t["id"]))
+        return
+
+    for s in get_submissions(t["id"]):
+        c1, c2 = st.columns([5, 2])
+        c1.write(f"{s['student_name']} — {(s['size'] or 0) // 1024} KB — {s['uploaded_at'][:16]}")
+        download(c2, s["path"], f"{s['student_name']}_{t['id']}.pdf", "sub_download", s["id"])
 
 
 # ------------ PERFORMANCE ------------
 def performance():
+    f1, f2 = st.columns(2)
+    branch = f1.selectbox("Branch", ["ALL"] + BRANCHES, key="perf_branch")
+    branch = None if branch == "ALL" else branch
+    months = f2.date_input("Attendance period (months)", value=(), key="perf_range")
+
     st.subheader("Task Performance")
-    st.dataframe(get_performance())
+    st.dataframe(get_performance(branch))
+
+    st.subheader("Completion by Task")
+    task_completion_table(branch)
+
+    st.subheader("Completion by Branch")
+    st.dataframe(get_branch_completion_stats(branch))
+
     st.subheader("Attendance Report")
-    st.dataframe(get_attendance_report())
+    if len(months) == 2:
+        start, end = (d.strftime("%Y-%m") for d in months)
+        st.dataframe(get_attendance_report(branch, start, end))
+    else:
+        st.dataframe(get_attendance_report(branch))
+
+
+STATS_PAGE_SIZE = 50
+
+
+def task_completion_table(branch):
+    body, rows = keyset_page(
+        "stats", branch,
+        lambda after, limit: get_task_completion_stats(branch, after=after, limit=limit),
+        STATS_PAGE_SIZE, lambda t: (t["deadline"], t["id"])
+    )
+    body.dataframe(rows)
 
 
 # ------------ LIBRARY ------------
+LIBRARY_SEARCH_LIMIT = 100
+
+
+def prepare_download(slot, item_id):
+    st.session_state[slot] = item_id
+
+
+def download(container, path, file_name, slot, item_id):
+    # With the file endpoint running the page only carries a signed link;
+    # otherwise the file is read once the user asks for this item.
+    if fileserver.enabled():
+        container.link_button("Download", fileserver.file_url(path, file_name))
+    elif st.session_state.get(slot) == item_id:
+        with instrument.span("io", "download_button"), open(path, "rb") as f:
+            container.download_button("Download", f, file_name=file_name,
+                                      key=f"{slot}_{item_id}")
+    else:
+        container.button("Prepare download", key=f"prep_{slot}_{item_id}",
+                         on_click=prepare_download, args=(slot, item_id))
+
+
 def library_page():
     user = st.session_state.current_user
     st.subheader("Library")
 
-    conn = get_db()
-
     if user["role"] == "teacher":
         title = st.text_input("PDF Title")
         desc = st.text_area("Description")
@@ -265,12 +452,11 @@ def library_page():
 
         if st.button("Upload PDF"):
             if upload:
-                path = f"library_files/{upload.name}"
-                with open(path, "wb") as f:
-                    f.write(upload.read())
-
-                add_library_item(title, desc, path, user["id"], branch)
-                st.success("PDF added to Library.")
+                sha, _, path = put_blob(upload)
+                add_library_item(title, desc, path, user["id"], branch,
+                                 blob_sha=sha, file_name=upload.name)
+                ingest.notify()
+                st.success("PDF added to Library. Its text will be indexed in the background.")
                 st.rerun()
 
         st.divider()
@@ -279,34 +465,41 @@ def library_page():
 
     search = st.text_input("Search library...")
 
-    items = get_library_items(
-        user["branch"] if user["role"] == "student" else None
-    )
-
+    branch = user["branch"] if user["role"] == "student" else None
     if search:
-        items = [i for i in items if search.lower() in i["title"].lower()]
+        items = search_library(search, branch, limit=LIBRARY_SEARCH_LIMIT)
+    else:
+        items = get_library_items(branch)
 
     if not items:
         st.info("No files found.")
         return
 
-    for item in items:
-        file_size = os.path.getsize(item["file_path"]) // 1024
-        uploader = conn.execute(
-            "SELECT name FROM users WHERE id=?",
-            (item["uploaded_by"],)
-        ).fetchone()
+    indexing = get_ingest_status([i["id"] for i in items]) if user["role"] == "teacher" else {}
 
-        uploader_name = uploader["name"] if uploader else "Unknown"
+    for item in items:
+        file_size = (item["file_size"] or 0) // 1024
 
         with st.expander(f"{item['title']}  |  {file_size} KB"):
             st.write(item["description"])
-            st.write(f"Uploaded by: **{uploader_name}**")
+            st.write(f"Uploaded by: **{item['uploader_name']}**")
             st.write(f"Date: {item['uploaded_at']}")
             st.write(f"Branch: {item['branch']}")
 
-            with open(item["file_path"], "rb") as f:
-                st.download_button("Download", f)
+            job = indexing.get(item["id"])
+            if job and job["status"] in ("pending", "running"):
+                if job["pages_total"]:
+                    st.progress(
+                        job["pages_done"] / job["pages_total"],
+                        text=f"Indexing text: {job['pages_done']}/{job['pages_total']} pages"
+                    )
+                else:
+                    st.caption("Waiting to index text…")
+            elif job and job["status"] == "failed":
+                st.caption(f"Text indexing failed: {job['error']}")
+
+            download(st, item["file_path"], os.path.basename(item["file_name"]),
+                     "lib_download", item["id"])
 
             if user["role"] == "teacher":
                 if st.button("Delete", key=f"del_{item['id']}"):
@@ -317,40 +510,175 @@ def library_page():
 
 # ------------ ADMIN ------------
 def admin_panel():
-    conn = get_db()
+    with st.expander("Bulk import students / teachers (CSV or Excel)"):
+        roster_import()
+    with st.expander("Export reports (CSV)"):
+        roster_export()
+
     st.subheader("Manage Students")
+    student_list()
 
-    for u in get_all_users():
-        if u["role"] == "student":
-            with st.expander(f"{u['name']} — {u['email']}"):
-                name = st.text_input("Name", u["name"], key=f"nm{u['id']}")
-                email = st.text_input("Email", u["email"], key=f"em{u['id']}")
-                branch = st.selectbox(
-                    "Branch", BRANCHES,
-                    index=BRANCHES.index(u["branch"]),
-                    key=f"br{u['id']}"
-                )
-                phone = st.text_input(
-                    "Phone",
-                    u.get("phone",""),
-                    key=f"ph{u['id']}"
-                )
-                pw = st.text_input("Reset Password", type="password", key=f"pw{u['id']}")
-
-                if st.button("Save", key=f"sv{u['id']}"):
-                    if pw:
-                        hashed = hash_password(pw)
-                        conn.execute(
-                            "UPDATE users SET name=?,email=?,branch=?,phone=?,password=? WHERE id=?",
-                            (name,email,branch,phone,hashed,u["id"])
-                        )
-                    else:
-                        conn.execute(
-                            "UPDATE users SET name=?,email=?,branch=?,phone=? WHERE id=?",
-                            (name,email,branch,phone,u["id"])
-                        )
-                    conn.commit()
-                    st.success("Updated")
+
+USER_PAGE_SIZE = 25
+
+
+def student_list():
+    f1, f2, f3 = st.columns(3)
+    name = f1.text_input("Name starts with", key="user_name")
+    email = f2.text_input("Email starts with", key="user_email")
+    branch = f3.selectbox("Branch", ["ALL"] + BRANCHES, key="user_branch")
+    filters = {"name": name.strip() or None, "email": email.strip() or None,
+               "branch": None if branch == "ALL" else branch}
+
+    body, rows = keyset_page(
+        "user", filters,
+        lambda after, limit: search_users(after=after, limit=limit, **filters),
+        USER_PAGE_SIZE, lambda u: (u["name"], u["id"]), editing="editing_user"
+    )
+    with body:
+        if not rows:
+            st.info("No students found.")
+
+        for u in rows:
+            c0, c1, c2, c3 = st.columns([1, 4, 3, 1])
+            thumb = avatar(u, 48)
+            if thumb:
+                c0.image(thumb, width=48)
+            c1.write(f"**{u['name']}** — {u['email']}")
+            c2.write(u["branch"] or "")
+            c3.button("Edit", key=f"openu{u['id']}", on_click=open_user_editor, args=(u["id"],))
+
+            if st.session_state.get("editing_user") == u["id"]:
+                user_editor(u)
+
+
+def open_user_editor(user_id):
+    st.session_state.editing_user = user_id
+
+
+def user_editor(u):
+    with st.container(border=True):
+        name = st.text_input("Name", u["name"], key=f"nm{u['id']}")
+        email = st.text_input("Email", u["email"], key=f"em{u['id']}")
+        branch = st.selectbox(
+            "Branch", BRANCHES,
+            index=BRANCHES.index(u["branch"]) if u["branch"] in BRANCHES else 0,
+            key=f"br{u['id']}"
+        )
+        phone = st.text_input(
+            "Phone",
+            u.get("phone") or "",
+            key=f"ph{u['id']}"
+        )
+        pw = st.text_input("Reset Password", type="password", key=f"pw{u['id']}")
+
+        b1, b2, b3 = st.columns([1, 1, 6])
+        if b1.button("Save", key=f"sv{u['id']}"):
+            update_user(u["id"], name, email, branch, phone, pw or None)
+            st.success("Updated")
+
+        if b2.button("Close", key=f"xu{u['id']}"):
+            st.session_state.editing_user = None
+            st.rerun()
+
+
+# ------------ DIAGNOSTICS ------------
+# Timings recorded in this server process (instrument.py). Enabled with
+# DIAGNOSTICS = "true" in secrets.
+def diagnostics():
+    st.subheader("Diagnostics")
+    st.caption(f"Recent samples per entry (last {instrument.RING_SIZE}); times in ms.")
+
+    c1, c2, c3, c4 = st.columns(4)
+    c1.write("Connection pool")
+    c1.json(get_pool_stats())
+    c2.write("Reference data cache")
+    c2.json(cache_stats())
+    c3.write("Write queue")
+    c3.json(writer.stats())
+    c4.write("Email outbox" if mailer.enabled() else "Email outbox (no SMTP configured)")
+    c4.json(get_outbox_stats())
+
+    for kind, label in (("page", "Pages"), ("db", "Data layer"),
+                        ("sql", "SQL statements"), ("writer", "Write batches"),
+                        ("io", "File I/O")):
+        st.subheader(label)
+        rows = instrument.summary(kind)
+        if rows:
+            st.dataframe(rows, hide_index=True, column_order=(
+                "name", "calls", "errors", "total_ms", "p50_ms", "p95_ms",
+                "p99_ms", "max_ms", "avg_rows"
+            ))
+        else:
+            st.info("No samples yet.")
+
+    if slowlog.enabled():
+        st.subheader(f"Slow queries (over {slowlog.THRESHOLD_MS:g} ms)")
+        rows = slowlog.report()
+        if rows:
+            st.dataframe(rows, hide_index=True, column_order=(
+                "statement", "count", "total_ms", "max_ms", "max_vm_steps",
+                "full_scans", "plan", "example"
+            ))
+        else:
+            st.info("None recorded in this process.")
+
+    if st.button("Reset timings"):
+        instrument.reset()
+        st.rerun()
+
+
+def roster_import():
+    st.caption("Columns: name, email, branch, phone, dob (YYYY-MM-DD), role, password. "
+               "Rows without a password get a generated one.")
+    upload = st.file_uploader("Roster file", type=["csv", "xlsx"], key="roster_file")
+    role = st.selectbox("Default role", roster.ROLES, key="roster_role")
+
+    if upload and st.button("Import", key="roster_import"):
+        status = st.empty()
+        with st.spinner("Importing..."):
+            result = roster.import_roster(
+                upload, upload.name, BRANCHES, role,
+                progress=lambda r: status.write(f"{r['read']} rows read, {r['inserted']} added")
+            )
+        status.empty()
+        st.session_state.roster_result = result
+
+    result = st.session_state.get("roster_result")
+    if result:
+        st.success(f"{result['inserted']} added, {result['skipped']} already registered, "
+                   f"{len(result['errors'])} rejected (of {result['read']} rows)")
+        if result["errors"]:
+            st.dataframe(result["errors"], hide_index=True)
+        if result["credentials"]:
+            st.warning("Generated passwords are shown only now; download and share them.")
+            st.download_button("Download generated passwords",
+                               roster.credentials_csv(result["credentials"]),
+                               file_name="roster-passwords.csv", key="roster_credentials")
+        if st.button("Clear", key="roster_clear"):
+            del st.session_state.roster_result
+            st.rerun()
+
+
+def roster_export():
+    e1, e2 = st.columns(2)
+    kind = e1.selectbox("Report", list(roster.EXPORTS), key="export_kind")
+    branch = e2.selectbox("Branch", ["ALL"] + BRANCHES, key="export_branch")
+    filters = {} if branch == "ALL" else {"branch": branch}
+    if kind == "attendance":
+        period = st.date_input("Period", value=(), key="export_period")
+        if len(period) == 2:
+            filters.update(start=period[0], end=period[1])
+
+    if st.button("Generate", key="export_generate"):
+        path = roster.export_file(kind, **filters)
+        st.session_state.export_file = (path, os.path.basename(path))
+        prepare_download("export_dl", path)
+
+    if st.session_state.get("export_file"):
+        path, file_name = st.session_state.export_file
+        if os.path.exists(path):
+            download(st, path, file_name, "export_dl", path)
 
 
 # ------------ CHAT SUPPORT ------------
@@ -390,6 +718,8 @@ def main_layout():
 
     if st.session_state.current_user["role"] == "teacher":
         menu += ["Performance", "Admin"]
+        if DIAGNOSTICS:
+            menu += ["Diagnostics"]
 
     menu += ["Logout"]
 
@@ -399,7 +729,10 @@ def main_layout():
 
         if st.sidebar.button(page, key=f"nav_{page}", use_container_width=True):
             if page == "Logout":
+                sessions.end_session(st.session_state.get("session_token"))
                 st.session_state.current_user = None
+                st.session_state.session_token = None
+                close_db()
                 st.rerun()
             else:
                 st.session_state.view = page
@@ -407,21 +740,28 @@ def main_layout():
 
     st.markdown('<div class="fade-container">', unsafe_allow_html=True)
 
-    match st.session_state.view:
-        case "Dashboard": dashboard()
-        case "Profile": profile_page()
-        case "Library": library_page()
-        case "Performance": performance()
-        case "Admin": admin_panel()
-        case "Help Chat": chat_support()
+    with instrument.span("page", st.session_state.view):
+        match st.session_state.view:
+            case "Dashboard": dashboard()
+            case "Profile": profile_page()
+            case "Library": library_page()
+            case "Performance": performance()
+            case "Admin": admin_panel()
+            case "Diagnostics": diagnostics()
+            case "Help Chat": chat_support()
 
     st.markdown('</div>', unsafe_allow_html=True)
 
 
 # ------------ ENTRY ------------
-if st.session_state.current_user:
-    main_layout()
-else:
-    login_screen()
+# The connection is returned to the pool at the end of every script run,
+# including reruns and stops raised by Streamlit itself.
+try:
+    if st.session_state.current_user:
+        main_layout()
+    else:
+        login_screen()
+finally:
+    close_db()
 
 
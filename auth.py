@@ -1,5 +1,7 @@
 import streamlit as st
-from db import get_user, get_db, hash_password
+import streamlit.components.v1 as components
+from db import get_user, create_user
+from sessions import start_session, COOKIE_NAME, SESSION_TTL
 
 BRANCHES = [
     "Computer Science",
@@ -14,6 +16,16 @@ BRANCHES = [
 ]
 
 
+def set_session_cookie(token):
+    # Streamlit reads cookies (st.context.cookies) but cannot set them, so
+    # a zero-height component writes it from the page; token=None clears it.
+    max_age = int(SESSION_TTL.total_seconds()) if token else 0
+    components.html(f"""<script>
+    parent.document.cookie = "{COOKIE_NAME}={token or ''}; path=/; max-age={max_age}; SameSite=Strict"
+        + (parent.location.protocol === "https:" ? "; Secure" : "");
+    </script>""", height=0)
+
+
 def login_screen():
     st.title("To-Do Planner RCPIT")
 
@@ -30,7 +42,10 @@ def login_screen():
             if not user:
                 st.error("Invalid email or password")
             else:
+                user.pop("password", None)
+                token = start_session(user)
                 st.session_state.current_user = user
+                st.session_state.session_token = token
                 st.success("Logged in successfully")
                 st.rerun()
 
@@ -46,14 +61,8 @@ def login_screen():
             if not name or not reg_email or not reg_pw:
                 st.error("All fields are required")
             else:
-                conn = get_db()
-
                 try:
-                    conn.execute(
-                        "INSERT INTO users (name,email,password,role,branch) VALUES (?,?,?,?,?)",
-                        (name, reg_email, hash_password(reg_pw), role, branch)
-                    )
-                    conn.commit()
+                    create_user(name, reg_email, reg_pw, role, branch)
                     st.success("Account created. You can login now.")
                 except Exception as e:
                     st.error("Email already exists or invalid data.")
@@ -0,0 +1,414 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Seeds a synthetic planner database per scale and times the db.py read
+# paths and the query mix behind each app.py page. Each scale runs in a
+# fresh process (db.py binds its database at import), and results are
+# printed as one JSON object per line so runs can be diffed or compared
+# against a saved baseline:
+#
+#   python benchmarks/bench_db.py --scales small medium > before.jsonl
+#   python benchmarks/bench_db.py --scales small medium --baseline before.jsonl
+
+SCALES = {
+    "small": dict(students=200, branches=4, tasks=200, years=1, library=200),
+    "medium": dict(students=2000, branches=8, tasks=2000, years=2, library=2000),
+    "large": dict(students=8000, branches=12, tasks=8000, years=3, library=10000),
+}
+
+TASK_PAGE_SIZE = 20           # app.task_list
+USER_PAGE_SIZE = 25           # app.student_list
+STATS_PAGE_SIZE = 50          # app.task_completion_table
+LIBRARY_SEARCH_LIMIT = 100    # app.library_page
+ATTENDANCE_DAYS = 366         # app.dashboard heatmap
+BURST_SESSIONS = 64           # concurrent "Complete" clicks in a write burst
+
+WORDS = (
+    "algebra calculus circuits compiler database electronics fluid graph "
+    "kinematics lattice matrix network optics probability quantum signals "
+    "statics thermodynamics vectors welding"
+).split()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[k]
+
+
+# ------ SEEDING ------
+def _school_days(start, end):
+    day = start
+    while day <= end:
+        if day.weekday() < 5:
+            yield day
+        day += timedelta(days=1)
+
+
+def seed(conn, scale, rng, today):
+    import passwords
+
+    branches = [f"B{i:02d}" for i in range(1, scale["branches"] + 1)]
+    stored = passwords.hash_password("bench")
+
+    teachers = max(1, scale["students"] // 50)
+    conn.executemany(
+        "INSERT INTO users (name, email, password, role, branch) VALUES (?,?,?,?,?)",
+        [(f"Teacher {i}", f"teacher{i}@bench.test", stored, "teacher", None)
+         for i in range(teachers)]
+    )
+    conn.executemany(
+        "INSERT INTO users (name, email, password, role, branch, phone) VALUES (?,?,?,?,?,?)",
+        [(f"Student {i:06d}", f"student{i}@bench.test", stored, "student",
+          branches[i % len(branches)], f"9{i:09d}")
+         for i in range(scale["students"])]
+    )
+    students = [tuple(r) for r in conn.execute(
+        "SELECT id, branch FROM users WHERE role='student'"
+    )]
+    teacher_ids = [r[0] for r in conn.execute("SELECT id FROM users WHERE role='teacher'")]
+    by_branch = {}
+    for sid, branch in students:
+        by_branch.setdefault(branch, []).append(sid)
+
+    start = today - timedelta(days=365 * scale["years"])
+    span = (today - start).days
+
+    # Mostly branch-wide tasks, some assigned to single students
+    tasks = []
+    for i in range(scale["tasks"]):
+        deadline = (start + timedelta(days=rng.randrange(span + 30))).isoformat()
+        if rng.random() < 0.7:
+            branch = rng.choice(branches)
+            tasks.append((f"Assignment {i}", f"Work on {rng.choice(WORDS)}", deadline,
+                          f"branch:{branch}", rng.choice(teacher_ids), "branch", None, branch))
+        else:
+            sid = rng.choice(students)[0]
+            tasks.append((f"Assignment {i}", f"Work on {rng.choice(WORDS)}", deadline,
+                          f"student:{sid}", rng.choice(teacher_ids), "student", sid, None))
+    conn.executemany(
+        """INSERT INTO tasks (title, description, deadline, assigned_to, created_by,
+                              assignee_type, assignee_id, assignee_branch)
+           VALUES (?,?,?,?,?,?,?,?)""",
+        tasks
+    )
+
+    completed, submissions = [], []
+    for task_id, kind, sid, branch, deadline in conn.execute(
+        "SELECT id, assignee_type, assignee_id, assignee_branch, deadline FROM tasks"
+    ).fetchall():
+        assignees = [sid] if kind == "student" else by_branch.get(branch, [])
+        for student_id in assignees:
+            if rng.random() < 0.6:
+                done = date.fromisoformat(deadline) + timedelta(days=rng.randint(-10, 3))
+                stamp = datetime.combine(done, datetime.min.time()).isoformat()
+                completed.append((student_id, task_id, stamp))
+                if rng.random() < 0.5:
+                    submissions.append((task_id, student_id,
+                                        f"submissions/{student_id}/{task_id}.pdf",
+                                        rng.randint(50_000, 5_000_000), stamp))
+    conn.executemany(
+        "INSERT INTO completed (student_id, task_id, completed_at) VALUES (?,?,?)", completed
+    )
+    conn.executemany(
+        """INSERT INTO submissions (task_id, student_id, path, size, uploaded_at)
+           VALUES (?,?,?,?,?)""",
+        submissions
+    )
+
+    days = [d.isoformat() for d in _school_days(start, today)]
+    for sid, _ in students:
+        rate = rng.uniform(0.6, 0.98)
+        conn.executemany(
+            "INSERT INTO attendance (student_id, date) VALUES (?,?)",
+            [(sid, d) for d in days if rng.random() < rate]
+        )
+
+    conn.executemany(
+        """INSERT INTO library (title, description, file_path, uploaded_by, branch,
+                                uploaded_at, file_size, file_name, body_text)
+           VALUES (?,?,?,?,?,?,?,?,?)""",
+        [(f"{rng.choice(WORDS).title()} notes {i}",
+          " ".join(rng.choices(WORDS, k=12)),
+          f"library_files/{i}.pdf", rng.choice(teacher_ids), rng.choice(branches),
+          (start + timedelta(days=rng.randrange(span))).isoformat(),
+          rng.randint(100_000, 20_000_000), f"{i}.pdf",
+          " ".join(rng.choices(WORDS, k=400)))
+         for i in range(scale["library"])]
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+# ------ WORKLOADS ------
+def workloads(db, rng, today):
+    from cache import invalidate
+
+    conn = db.get_db()
+    branches = [r[0] for r in conn.execute(
+        "SELECT DISTINCT branch FROM users WHERE role='student' ORDER BY branch"
+    )]
+    students = [dict(r) for r in conn.execute(
+        "SELECT id, name, email, branch FROM users WHERE role='student'"
+    )]
+    last_task = conn.execute("SELECT MAX(id) FROM tasks").fetchone()[0] or 0
+    this_month = today.strftime("%Y-%m")
+    three_months = (today.replace(day=1) - timedelta(days=62)).strftime("%Y-%m")
+
+    def student():
+        return rng.choice(students)
+
+    def branch():
+        return rng.choice(branches)
+
+    def tasks_for_student():
+        s = student()
+        return db.get_tasks_for_student(s["id"], s["branch"])
+
+    def cold_students(branch=None):
+        # get_students is cached; invalidate first to time the query itself
+        invalidate("users")
+        return db.get_students(branch)
+
+    def student_dashboard():
+        s = student()
+        return (len(db.get_tasks_for_student(s["id"], s["branch"]))
+                + len(db.get_student_submissions(s["id"]))
+                + db.get_attendance_bitmap(s["id"], ATTENDANCE_DAYS, today)[1].bit_count())
+
+    def teacher_dashboard():
+        tasks = db.get_tasks(limit=TASK_PAGE_SIZE + 1)[:TASK_PAGE_SIZE]
+        for t in tasks:
+            db.count_submissions(t["id"])
+        return len(cold_students()) + len(cold_students(branch())) + len(tasks)
+
+    def task_page_deep():
+        return db.get_tasks(after_id=rng.randrange(last_task + 1), limit=TASK_PAGE_SIZE + 1)
+
+    def performance_page():
+        b = branch()
+        return (len(db.get_performance(b))
+                + len(db.get_task_completion_stats(b, limit=STATS_PAGE_SIZE + 1))
+                + len(db.get_branch_completion_stats(b))
+                + len(db.get_attendance_report(b)))
+
+    def library_page():
+        return len(db.get_library_items(branch()))
+
+    def library_search_page():
+        return len(db.search_library(rng.choice(WORDS)[:4], branch(), limit=LIBRARY_SEARCH_LIMIT))
+
+    def user_page_deep():
+        s = student()
+        return db.search_users(after=(s["name"], s["id"]), limit=USER_PAGE_SIZE + 1)
+
+    burst_rows = []
+
+    def complete(pair):
+        if db.mark_completed(*pair):
+            burst_rows.append(pair)
+
+    def completion_burst():
+        # A deadline wave: many sessions marking tasks complete at once.
+        # Pairs are drawn up front so every run submits the same ones.
+        pairs = [(student()["id"], rng.randrange(1, last_task + 1)) for _ in range(BURST_SESSIONS)]
+        with ThreadPoolExecutor(BURST_SESSIONS) as pool:
+            list(pool.map(complete, pairs))
+        return len(burst_rows)
+
+    def undo_completion_burst():
+        # The seeded database is reused across runs; without this a rerun
+        # would mostly hit INSERT OR IGNORE no-ops and measure less work.
+        conn = db.get_db()
+        conn.executemany("DELETE FROM completed WHERE student_id=? AND task_id=?", burst_rows)
+        conn.commit()
+        burst_rows.clear()
+
+    return [
+        # db.py functions
+        ("get_tasks", lambda: db.get_tasks(limit=TASK_PAGE_SIZE + 1)),
+        ("get_tasks_branch", lambda: db.get_tasks(limit=TASK_PAGE_SIZE + 1, branch=branch())),
+        ("get_tasks_search", lambda: db.get_tasks(limit=TASK_PAGE_SIZE + 1, search=str(rng.randrange(100)))),
+        ("get_tasks_deep_page", task_page_deep),
+        ("get_tasks_all", lambda: db.get_tasks()),
+        ("get_tasks_for_student", tasks_for_student),
+        ("get_student_submissions", lambda: db.get_student_submissions(student()["id"])),
+        ("get_attendance", lambda: db.get_attendance(student()["id"])),
+        ("get_attendance_bitmap", lambda: db.get_attendance_bitmap(student()["id"], ATTENDANCE_DAYS, today)),
+        ("get_attendance_report", lambda: db.get_attendance_report()),
+        ("get_attendance_report_branch", lambda: db.get_attendance_report(branch())),
+        ("get_attendance_report_months", lambda: db.get_attendance_report(branch(), three_months, this_month)),
+        ("get_performance", lambda: db.get_performance()),
+        ("get_performance_branch", lambda: db.get_performance(branch())),
+        ("get_task_completion_stats", lambda: db.get_task_completion_stats(limit=STATS_PAGE_SIZE + 1)),
+        ("get_task_completion_stats_branch",
+         lambda: db.get_task_completion_stats(branch(), limit=STATS_PAGE_SIZE + 1)),
+        ("get_task_completion_stats_all", lambda: db.get_task_completion_stats()),
+        ("get_branch_completion_stats", lambda: db.get_branch_completion_stats()),
+        ("get_library_items", lambda: db.get_library_items()),
+        ("get_library_items_branch", lambda: db.get_library_items(branch())),
+        ("search_library", lambda: db.search_library(rng.choice(WORDS)[:4], limit=LIBRARY_SEARCH_LIMIT)),
+        ("get_students", cold_students),
+        ("get_students_branch", lambda: cold_students(branch())),
+        ("search_users", lambda: db.search_users(limit=USER_PAGE_SIZE + 1)),
+        ("search_users_branch", lambda: db.search_users(branch=branch(), limit=USER_PAGE_SIZE + 1)),
+        ("search_users_name", lambda: db.search_users(name=student()["name"][:9], limit=USER_PAGE_SIZE + 1)),
+        ("search_users_email", lambda: db.search_users(email=student()["email"][:9], limit=USER_PAGE_SIZE + 1)),
+        ("search_users_deep_page", user_page_deep),
+        # app.py pages (the queries each page issues on a rerun)
+        ("page_student_dashboard", student_dashboard),
+        ("page_teacher_dashboard", teacher_dashboard),
+        ("page_performance", performance_page),
+        ("page_library", library_page),
+        ("page_library_search", library_search_page),
+        # writes
+        ("write_completion_burst", completion_burst, undo_completion_burst),
+    ]
+
+
+def _rows(result):
+    if isinstance(result, int):
+        return result
+    if isinstance(result, (list, dict)):
+        return len(result)
+    return None
+
+
+def run_scale(name, scale, data_dir, repeat, reseed, rng_seed, only):
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, "bench-{}-s{students}-b{branches}-t{tasks}-y{years}-l{library}-r{seed}.db".format(
+        name, seed=rng_seed, **scale))
+    if reseed:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+    fresh = not os.path.exists(path)
+
+    # db.py opens DB_NAME and migrates at import time
+    os.environ["PLANNER_DB"] = path
+    import db
+
+    today = date.today()
+    seed_s = None
+    if fresh:
+        started = time.perf_counter()
+        seed(db.get_db(), scale, random.Random(rng_seed), today)
+        seed_s = round(time.perf_counter() - started, 2)
+
+    common = {
+        "scale": name,
+        **scale,
+        "db_bytes": os.path.getsize(path),
+        "seed_s": seed_s,
+        "fts": db.HAS_FTS,
+        "sqlite": sqlite3.sqlite_version,
+    }
+
+    results = []
+    rng = random.Random(rng_seed)
+    for workload, fn, *undo in workloads(db, rng, today):
+        # Write workloads come with an undo step, run untimed after every
+        # call, so each repetition and each run starts from the seeded data.
+        undo = undo[0] if undo else lambda: None
+        if only and workload not in only:
+            continue
+        rows = _rows(fn())  # warm the page cache and statement cache
+        undo()
+        latencies = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            latencies.append((time.perf_counter() - started) * 1000)
+            undo()
+        results.append(dict(
+            common,
+            workload=workload,
+            rows=rows,
+            repeat=repeat,
+            p50_ms=round(statistics.median(latencies), 3),
+            p95_ms=round(percentile(latencies, 95), 3),
+            max_ms=round(max(latencies), 3),
+        ))
+    db.close_all()
+    return results
+
+
+def load_baseline(path):
+    baseline = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                baseline[(r["scale"], r["workload"])] = r
+    return baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description="db.py data layer benchmark")
+    parser.add_argument("--scales", nargs="*", default=["small", "medium"],
+                        choices=sorted(SCALES) + ["custom"])
+    parser.add_argument("--students", type=int, help="custom scale: number of students")
+    parser.add_argument("--branches", type=int, help="custom scale: number of branches")
+    parser.add_argument("--tasks", type=int, help="custom scale: number of tasks")
+    parser.add_argument("--years", type=int, help="custom scale: years of attendance")
+    parser.add_argument("--library", type=int, help="custom scale: number of library items")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="workload names to run")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "planner-bench"),
+                        help="where seeded databases are kept between runs")
+    parser.add_argument("--reseed", action="store_true", help="rebuild seeded databases")
+    parser.add_argument("--baseline", help="JSON lines from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="fail when p50 exceeds baseline p50 by this factor")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+    regressions = []
+
+    for name in args.scales:
+        scale = dict(SCALES.get(name, SCALES["small"]))
+        if name == "custom":
+            for key in scale:
+                if getattr(args, key) is not None:
+                    scale[key] = getattr(args, key)
+
+        # A fresh interpreter per scale, so each run imports db against its
+        # own database and starts with cold caches.
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            results = pool.submit(run_scale, name, scale, args.data_dir, args.repeat,
+                                  args.reseed, args.seed, args.only).result()
+
+        for r in results:
+            base = baseline.get((r["scale"], r["workload"]))
+            if base:
+                r["baseline_p50_ms"] = base["p50_ms"]
+                r["ratio"] = round(r["p50_ms"] / base["p50_ms"], 2) if base["p50_ms"] else None
+                if r["ratio"] and r["ratio"] > args.tolerance:
+                    regressions.append(r)
+            print(json.dumps(r), flush=True)
+
+    for r in regressions:
+        print(f"REGRESSION {r['scale']}/{r['workload']}: p50 {r['p50_ms']} ms "
+              f"vs {r['baseline_p50_ms']} ms (x{r['ratio']})", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import passwords
+
+# Measures login-time password verification under a burst of concurrent
+# logins (e.g. a class signing in at 9 AM) for several cost settings, and
+# recommends the highest cost whose p99 stays inside the latency budget.
+#
+#   python benchmarks/bench_passwords.py --concurrency 32 --logins 256 --budget-ms 250
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[k]
+
+
+def run(scheme, cost, logins, concurrency):
+    stored = passwords.hash_password("correct horse battery staple", scheme, cost)
+
+    def login(_):
+        start = time.perf_counter()
+        passwords.verify_password("correct horse battery staple", stored)
+        return (time.perf_counter() - start) * 1000
+
+    wall = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(login, range(logins)))
+    wall = time.perf_counter() - wall
+
+    return {
+        "scheme": scheme,
+        "cost": cost,
+        "logins": logins,
+        "concurrency": concurrency,
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "logins_per_s": round(logins / wall, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Password hashing cost benchmark")
+    parser.add_argument("--scheme", choices=["scrypt", "pbkdf2_sha256"], default=passwords.SCHEME)
+    parser.add_argument("--costs", type=int, nargs="*",
+                        help="scrypt N values or PBKDF2 iteration counts to try")
+    parser.add_argument("--logins", type=int, default=128)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--budget-ms", type=float, default=250.0)
+    parser.add_argument("--json", action="store_true", help="print one JSON object per line")
+    args = parser.parse_args()
+
+    costs = args.costs or (
+        [2 ** k for k in range(12, 18)] if args.scheme == "scrypt"
+        else [100_000, 200_000, 400_000, 600_000, 1_000_000]
+    )
+
+    best = None
+    for cost in costs:
+        result = run(args.scheme, cost, args.logins, args.concurrency)
+        result["within_budget"] = result["p99_ms"] <= args.budget_ms
+        if result["within_budget"]:
+            best = cost
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{args.scheme:14} cost={cost:<8} p50={result['p50_ms']:>8}ms "
+                  f"p99={result['p99_ms']:>8}ms {result['logins_per_s']:>7}/s"
+                  f"{'' if result['within_budget'] else '  over budget'}")
+
+    if not args.json:
+        if best is None:
+            print(f"No cost setting kept p99 under {args.budget_ms} ms.")
+        else:
+            env = "PLANNER_SCRYPT_N" if args.scheme == "scrypt" else "PLANNER_PBKDF2_ITERATIONS"
+            print(f"Recommended: {env}={best}")
+
+
+if __name__ == "__main__":
+    main()
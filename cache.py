@@ -0,0 +1,67 @@
+import threading
+import time
+from functools import wraps
+
+# In-process cache for small, read-mostly reference data (rosters, names).
+# Entries expire after their TTL and writers call invalidate() explicitly.
+DEFAULT_TTL = 300
+
+_lock = threading.Lock()
+_entries = {}
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_generations = {}
+
+
+def cached(namespace, ttl=DEFAULT_TTL):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (namespace, fn.__name__, args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+
+            with _lock:
+                entry = _entries.get(key)
+                if entry and entry[0] > now:
+                    _stats["hits"] += 1
+                    return entry[1]
+                _stats["misses"] += 1
+                gen = _generations.setdefault(namespace, 0)
+
+            value = fn(*args, **kwargs)
+            with _lock:
+                # An invalidate() while fn ran means value may predate the
+                # write; return it, but don't keep it for the whole TTL.
+                if _generations.get(namespace) == gen:
+                    _entries[key] = (now + ttl, value)
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidate(namespace=None):
+    with _lock:
+        if namespace is None:
+            _entries.clear()
+            for ns in _generations:
+                _generations[ns] += 1
+        else:
+            for key in [k for k in _entries if k[0] == namespace]:
+                del _entries[key]
+            _generations[namespace] = _generations.get(namespace, 0) + 1
+        _stats["invalidations"] += 1
+
+
+def generation(namespace):
+    # Bumped on every invalidate(), for callers keeping their own copies.
+    with _lock:
+        return _generations.setdefault(namespace, 0)
+
+
+def cache_stats():
+    with _lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return dict(
+            _stats,
+            entries=len(_entries),
+            hit_rate=round(_stats["hits"] / lookups, 3) if lookups else None,
+        )
@@ -1,173 +1,492 @@
+import os
+import re
+import queue
+import secrets
 import sqlite3
-import hashlib
-from datetime import date, datetime
+import threading
+import weakref
+from datetime import date, datetime, timedelta
+
+import instrument
+import migrations
+import passwords
+import slowlog
+import storage
+import writer
+from cache import cached, invalidate
+
+DB_NAME = os.environ.get("PLANNER_DB", "planner.db")
+HAS_FTS = False
+
+# ------ CONNECTION POOL ------
+# Each Streamlit script run happens on its own thread, so connections are
+# handed out per thread and go back to a shared pool when the thread calls
+# close_db() or exits.
+POOL_SIZE = int(os.environ.get("PLANNER_DB_POOL_SIZE", "16"))
+POOL_TIMEOUT = 30
+BUSY_TIMEOUT_MS = 5000
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA temp_store=MEMORY",
+)
+
+_idle = queue.LifoQueue()
+_local = threading.local()
+_pool_lock = threading.Lock()
+_pool_stats = {"opened": 0, "reused": 0, "waited": 0, "closed": 0, "in_use": 0}
+
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_NAME, check_same_thread=False, timeout=BUSY_TIMEOUT_MS / 1000,
+        factory=instrument.TimedConnection
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    if slowlog.enabled():
+        slowlog.attach(conn)
+    return conn
+
+
+def _checkout():
+    try:
+        conn = _idle.get_nowait()
+        with _pool_lock:
+            _pool_stats["reused"] += 1
+            _pool_stats["in_use"] += 1
+        return conn
+    except queue.Empty:
+        pass
+
+    with _pool_lock:
+        can_open = _pool_stats["in_use"] < POOL_SIZE
+        if can_open:
+            _pool_stats["opened"] += 1
+            _pool_stats["in_use"] += 1
+        else:
+            _pool_stats["waited"] += 1
+
+    if can_open:
+        return _connect()
+
+    try:
+        conn = _idle.get(timeout=POOL_TIMEOUT)
+    except queue.Empty:
+        raise sqlite3.OperationalError("database connection pool exhausted")
+    with _pool_lock:
+        _pool_stats["reused"] += 1
+        _pool_stats["in_use"] += 1
+    return conn
+
 
-DB_NAME = "planner.db"
+def _release(conn):
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        with _pool_lock:
+            _pool_stats["in_use"] -= 1
+            _pool_stats["closed"] += 1
+        conn.close()
+        return
+    with _pool_lock:
+        _pool_stats["in_use"] -= 1
+    _idle.put(conn)
+
+
+class _Lease:
+    # Lives in the thread-local; when the thread ends the lease is collected
+    # and its connection is returned to the pool.
+    def __init__(self, conn):
+        self.conn = conn
+        self.finalizer = weakref.finalize(self, _release, conn)
 
 
 def get_db():
-    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    lease = getattr(_local, "lease", None)
+    if lease is None:
+        lease = _Lease(_checkout())
+        _local.lease = lease
+    return lease.conn
+
+
+def close_db():
+    lease = getattr(_local, "lease", None)
+    if lease is not None:
+        _local.lease = None
+        lease.finalizer()
+
+
+def close_all():
+    close_db()
+    while True:
+        try:
+            conn = _idle.get_nowait()
+        except queue.Empty:
+            break
+        conn.close()
+        with _pool_lock:
+            _pool_stats["closed"] += 1
+
+
+def get_pool_stats():
+    with _pool_lock:
+        return dict(_pool_stats, idle=_idle.qsize(), size=POOL_SIZE)
 
 
 def hash_password(password: str):
-    return hashlib.sha256(password.encode()).hexdigest()
+    return passwords.hash_password(password)
+
+
+# ------ SCHEMA ------
+# Table definitions live in migrations.py; init_db() applies any pending
+# ones once per process.
+_migrate_lock = threading.Lock()
+_migrated = False
 
 
 def init_db():
-    conn = get_db()
+    global HAS_FTS, _migrated
+    with _migrate_lock:
+        if _migrated:
+            return
+        conn = get_db()
+        migrations.migrate(conn)
+        HAS_FTS = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='library_fts'"
+        ).fetchone() is not None
+        _migrated = True
+
+
+# ------ WRITES ------
+# User-facing mutations run on the single writer thread (writer.py), which
+# groups concurrent writes into shared transactions. The _op functions take
+# the writer's connection and must not commit.
+def _write(op, *args):
+    return writer.run(op, *args)
+
+
+def rebuild_reports(conn=None):
+    conn = conn or get_db()
+    with conn:
+        migrations.rebuild_reports(conn)
+        migrations.rebuild_completion_stats(conn)
+
+
+# -------- SETTINGS --------
+_secrets = {}
+
+
+def get_secret(name):
+    # Random per-installation keys (link signing etc.), shared by every
+    # process using this database.
+    if name not in _secrets:
+        conn = get_db()
+        conn.execute(
+            "INSERT OR IGNORE INTO settings (key, value) VALUES (?,?)",
+            (f"secret:{name}", secrets.token_hex(32))
+        )
+        conn.commit()
+        _secrets[name] = conn.execute(
+            "SELECT value FROM settings WHERE key=?", (f"secret:{name}",)
+        ).fetchone()["value"]
+    return _secrets[name]
 
-    # ------ USERS ------
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        email TEXT UNIQUE,
-        password TEXT,
-        role TEXT,
-        branch TEXT,
-        phone TEXT,
-        dob TEXT,
-        photo_path TEXT
-    )
-    """)
-
-    # MIGRATION (adds new fields if DB existed earlier)
-    try: conn.execute("ALTER TABLE users ADD COLUMN phone TEXT")
-    except: pass
-
-    try: conn.execute("ALTER TABLE users ADD COLUMN dob TEXT")
-    except: pass
-
-    try: conn.execute("ALTER TABLE users ADD COLUMN photo_path TEXT")
-    except: pass
-
-    # ------ TASKS ------
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS tasks (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT,
-        description TEXT,
-        deadline TEXT,
-        assigned_to TEXT,
-        created_by INTEGER,
-        pdf_path TEXT
-    )
-    """)
-
-    # ------ COMPLETED ------
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS completed (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        student_id INTEGER,
-        task_id INTEGER
-    )
-    """)
-
-    # ------ ATTENDANCE ------
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS attendance (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        student_id INTEGER,
-        date TEXT
-    )
-    """)
-
-    # ------ LIBRARY ------
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS library (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT,
-        description TEXT,
-        file_path TEXT,
-        uploaded_by INTEGER,
-        branch TEXT,
-        uploaded_at TEXT
+
+# -------- SESSIONS --------
+def create_session(id_hash, user_id, expires_at):
+    _write(_create_session, id_hash, user_id, expires_at)
+
+
+def _create_session(conn, id_hash, user_id, expires_at):
+    now = datetime.now().isoformat()
+    conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+    conn.execute(
+        "INSERT INTO sessions (id_hash, user_id, created_at, expires_at) VALUES (?,?,?,?)",
+        (id_hash, user_id, now, expires_at.isoformat())
     )
-    """)
 
-    # Library migrations (for older DBs)
-    try: conn.execute("ALTER TABLE library ADD COLUMN branch TEXT")
-    except: pass
 
-    try: conn.execute("ALTER TABLE library ADD COLUMN uploaded_at TEXT")
-    except: pass
+def rotate_session_row(old_hash, id_hash, user_id, expires_at, old_expires_at):
+    _write(_rotate_session, old_hash, id_hash, user_id, expires_at, old_expires_at)
 
-    conn.commit()
+
+def _rotate_session(conn, old_hash, id_hash, user_id, expires_at, old_expires_at):
+    conn.execute("UPDATE sessions SET expires_at=MIN(expires_at, ?) WHERE id_hash=?",
+                 (old_expires_at.isoformat(), old_hash))
+    _create_session(conn, id_hash, user_id, expires_at)
+
+
+def get_session_user(id_hash):
+    conn = get_db()
+    row = conn.execute("""
+        SELECT u.*, s.expires_at AS session_expires_at
+        FROM sessions s JOIN users u ON u.id = s.user_id
+        WHERE s.id_hash=? AND s.expires_at > ?
+    """, (id_hash, datetime.now().isoformat())).fetchone()
+    return dict(row) if row else None
+
+
+def delete_session(id_hash):
+    _write(_execute, "DELETE FROM sessions WHERE id_hash=?", (id_hash,))
+
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).rowcount
 
 
 # -------- USERS --------
 def get_user(email, password):
     conn = get_db()
-    pw = hash_password(password)
-    row = conn.execute(
-        "SELECT * FROM users WHERE email=? AND password=?",
-        (email, pw)
-    ).fetchone()
-    return dict(row) if row else None
+    row = conn.execute("SELECT * FROM users WHERE email=?", (email,)).fetchone()
+    if not row:
+        passwords.dummy_verify(password)
+        return None
+    if not passwords.verify_password(password, row["password"]):
+        return None
+
+    user = dict(row)
+    if passwords.needs_rehash(row["password"]):
+        # Legacy SHA-256 rows and outdated cost settings upgrade on login
+        _write(_execute, "UPDATE users SET password=? WHERE id=? AND password=?",
+               (hash_password(password), row["id"], row["password"]))
+    return user
+
+
+def create_user(name, email, password, role, branch):
+    _write(_execute, "INSERT INTO users (name,email,password,role,branch) VALUES (?,?,?,?,?)",
+           (name, email, hash_password(password), role, branch))
+    invalidate("users")
+
+
+def update_profile(user_id, name, phone, dob, photo_path, photo_sha=None):
+    _write(
+        _execute,
+        """UPDATE users SET name=?, phone=?, dob=?, photo_path=?,
+                            photo_sha=COALESCE(?, photo_sha)
+           WHERE id=?""",
+        (name, phone, dob, photo_path, photo_sha, user_id)
+    )
+    invalidate("users")
+    collect_blobs()
+
+
+def update_user(user_id, name, email, branch, phone, password=None):
+    if password:
+        _write(_execute, "UPDATE users SET name=?,email=?,branch=?,phone=?,password=? WHERE id=?",
+               (name, email, branch, phone, hash_password(password), user_id))
+    else:
+        _write(_execute, "UPDATE users SET name=?,email=?,branch=?,phone=? WHERE id=?",
+               (name, email, branch, phone, user_id))
+    invalidate("users")
 
 
-def get_all_users():
+@cached("users")
+def get_students(branch=None):
     conn = get_db()
-    return [dict(r) for r in conn.execute("SELECT * FROM users").fetchall()]
+    sql = "SELECT id, name, email, branch, phone, photo_sha FROM users WHERE role='student'"
+    if branch:
+        rows = conn.execute(sql + " AND branch=? ORDER BY name", (branch,)).fetchall()
+    else:
+        rows = conn.execute(sql + " ORDER BY name").fetchall()
+    return [dict(r) for r in rows]
 
 
-# -------- TASKS --------
-def add_task(title, desc, deadline, assigned_to, teacher_id):
+def search_users(role="student", branch=None, name=None, email=None, after=None, limit=None):
+    # Keyset pagination on (name, id): `after` is the (name, id) of the last
+    # row of the previous page. Walks idx_users_role_branch or
+    # idx_users_role_name in order, so a page costs the same at any depth.
     conn = get_db()
+    where, params = ["role=?"], [role]
+
+    if branch:
+        where.append("branch=?")
+        params.append(branch)
+    if name:
+        # Case-insensitive prefix; checked against the index entries
+        # before any table row is read.
+        where.append("name LIKE ? ESCAPE '\\'")
+        params.append(re.sub(r"([\\%_])", r"\\\1", name) + "%")
+    if email:
+        # Emails match exactly at login, so the prefix is case-sensitive
+        # too and can use the UNIQUE index as a range.
+        where.append("email >= ? AND email < ?")
+        params += [email, email[:-1] + chr(ord(email[-1]) + 1)]
+    if after is not None:
+        where.append("(name, id) > (?, ?)")
+        params += list(after)
+
+    sql = ("SELECT id, name, email, branch, phone, photo_sha FROM users WHERE "
+           + " AND ".join(where) + " ORDER BY name, id")
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    return [dict(r) for r in conn.execute(sql, params).fetchall()]
+
+
+# -------- TASKS --------
+def parse_assignee(assigned_to):
+    kind, _, value = assigned_to.partition(":")
+    if kind == "student":
+        return "student", int(value), None
+    if kind == "branch":
+        return "branch", None, value
+    raise ValueError(f"Invalid assignee: {assigned_to!r}")
+
+
+def add_task(title, desc, deadline, assigned_to, teacher_id, notify=False):
+    return _write(_add_task, title, desc, deadline, parse_assignee(assigned_to),
+                  assigned_to, teacher_id, notify)
+
+
+def _add_task(conn, title, desc, deadline, assignee, assigned_to, teacher_id, notify):
+    assignee_type, assignee_id, assignee_branch = assignee
+    now = datetime.now().isoformat()
+    cur = conn.execute(
+        """INSERT INTO tasks (title,description,deadline,assigned_to,created_by,
+                              assignee_type,assignee_id,assignee_branch)
+           VALUES (?,?,?,?,?,?,?,?)""",
+        (title, desc, deadline, assigned_to, teacher_id,
+         assignee_type, assignee_id, assignee_branch)
+    )
+
+    if not notify:
+        return cur.lastrowid
+
+    # One notification per affected student, queued with the task itself
     conn.execute(
-        "INSERT INTO tasks (title,description,deadline,assigned_to,created_by) VALUES (?,?,?,?,?)",
-        (title, desc, deadline, assigned_to, teacher_id)
+        """INSERT INTO outbox (recipient, subject, body, created_at, next_attempt_at)
+           SELECT email, ?, ?, ?, ? FROM users
+           WHERE role='student' AND email IS NOT NULL AND email != ''
+             AND (id=? OR branch=?)""",
+        (f"New task: {title}",
+         f"A new task has been assigned to you.\n\n{title}\nDeadline: {deadline}\n\n{desc or ''}",
+         now, now, assignee_id, assignee_branch)
     )
-    conn.commit()
+    return cur.lastrowid
 
 
-def get_tasks():
+def get_tasks(after_id=None, limit=None, branch=None, student_id=None, search=None):
     conn = get_db()
-    return [dict(r) for r in conn.execute("SELECT * FROM tasks").fetchall()]
+    where, params = [], []
+
+    if after_id is not None:
+        where.append("id > ?")
+        params.append(after_id)
+    if branch:
+        where.append("assignee_type='branch' AND assignee_branch=?")
+        params.append(branch)
+    if student_id is not None:
+        where.append("assignee_type='student' AND assignee_id=?")
+        params.append(student_id)
+    if search:
+        where.append("title LIKE ?")
+        params.append(f"%{search}%")
+
+    sql = "SELECT * FROM tasks"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    return [dict(r) for r in conn.execute(sql, params).fetchall()]
+
+
+def get_tasks_for_student(user_id, branch):
+    conn = get_db()
+    return [dict(r) for r in conn.execute("""
+        SELECT * FROM tasks WHERE assignee_type='student' AND assignee_id=?
+        UNION ALL
+        SELECT * FROM tasks WHERE assignee_type='branch' AND assignee_branch=?
+        ORDER BY deadline, id
+    """, (user_id, branch)).fetchall()]
 
 
 def update_task(task_id, title, desc, deadline):
-    conn = get_db()
-    conn.execute(
-        "UPDATE tasks SET title=?, description=?, deadline=? WHERE id=?",
-        (title, desc, deadline, task_id)
-    )
-    conn.commit()
+    _write(_execute, "UPDATE tasks SET title=?, description=?, deadline=? WHERE id=?",
+           (title, desc, deadline, task_id))
 
 
 def delete_task(task_id):
-    conn = get_db()
+    _write(_delete_task, task_id)
+    collect_blobs()
+
+
+def _delete_task(conn, task_id):
     conn.execute("DELETE FROM tasks WHERE id=?", (task_id,))
-    conn.commit()
+    conn.execute("DELETE FROM submissions WHERE task_id=?", (task_id,))
+
+
+# -------- SUBMISSIONS --------
+def save_submission(task_id, student_id, path, size, sha256):
+    # path is the blob the upload was stored in, so sha256 is also its key.
+    _write(
+        _execute,
+        """INSERT INTO submissions (task_id, student_id, path, size, sha256, blob_sha, uploaded_at)
+           VALUES (?,?,?,?,?,?,?)
+           ON CONFLICT (task_id, student_id) DO UPDATE SET
+               path=excluded.path, size=excluded.size, sha256=excluded.sha256,
+               blob_sha=excluded.blob_sha, uploaded_at=excluded.uploaded_at""",
+        (task_id, student_id, path, size, sha256, sha256, datetime.now().isoformat())
+    )
+    collect_blobs()
 
 
-def mark_completed(student_id, task_id):
+def get_student_submissions(student_id):
     conn = get_db()
-    conn.execute(
-        "INSERT INTO completed (student_id, task_id) VALUES (?,?)",
-        (student_id, task_id)
-    )
-    conn.commit()
+    return {r["task_id"]: dict(r) for r in conn.execute(
+        "SELECT * FROM submissions WHERE student_id=?", (student_id,)
+    ).fetchall()}
 
 
-# -------- ATTENDANCE --------
-def mark_attendance(student_id):
+def get_submissions(task_id):
     conn = get_db()
-    today = date.today().isoformat()
+    return [dict(r) for r in conn.execute("""
+        SELECT s.*, COALESCE(u.name, 'Unknown') AS student_name, u.branch
+        FROM submissions s LEFT JOIN users u ON u.id = s.student_id
+        WHERE s.task_id=?
+        ORDER BY s.uploaded_at DESC
+    """, (task_id,)).fetchall()]
 
-    exists = conn.execute(
-        "SELECT 1 FROM attendance WHERE student_id=? AND date=?",
-        (student_id, today)
-    ).fetchone()
 
-    if not exists:
-        conn.execute(
-            "INSERT INTO attendance (student_id, date) VALUES (?,?)",
-            (student_id, today)
-        )
-        conn.commit()
+def count_submissions(task_id):
+    conn = get_db()
+    return conn.execute(
+        "SELECT COUNT(*) FROM submissions WHERE task_id=?", (task_id,)
+    ).fetchone()[0]
+
+
+def mark_completed(student_id, task_id):
+    return _write(
+        _execute,
+        "INSERT OR IGNORE INTO completed (student_id, task_id, completed_at) VALUES (?,?,?)",
+        (student_id, task_id, datetime.now().isoformat())
+    ) == 1
+
+
+# -------- ATTENDANCE --------
+def mark_attendance(student_id, day=None):
+    return mark_attendance_bulk([student_id], day)
+
+
+def mark_attendance_bulk(student_ids, day=None):
+    day = (day or date.today()).isoformat()
+    return _write(_execute_many, "INSERT OR IGNORE INTO attendance (student_id, date) VALUES (?,?)",
+                  [(sid, day) for sid in student_ids])
+
+
+def _execute_many(conn, sql, rows):
+    # rowcount leaves out rows written by triggers (unlike total_changes)
+    return conn.executemany(sql, rows).rowcount
 
 
 def get_attendance(student_id):
@@ -178,55 +497,471 @@ def get_attendance(student_id):
     ).fetchall()]
 
 
-def get_attendance_report():
+def get_attendance_bitmap(student_id, days=366, today=None):
+    # Bit i is set when the student attended on start + i days.
+    today = today or date.today()
+    start = today - timedelta(days=days - 1)
     conn = get_db()
-    return [dict(r) for r in conn.execute("""
-        SELECT u.name, u.branch, COUNT(a.id) AS attended_days
-        FROM users u
-        LEFT JOIN attendance a ON u.id = a.student_id
-        WHERE u.role='student'
-        GROUP BY u.id
-    """).fetchall()]
+    rows = conn.execute(
+        "SELECT date FROM attendance WHERE student_id=? AND date BETWEEN ? AND ?",
+        (student_id, start.isoformat(), today.isoformat())
+    ).fetchall()
+
+    bitmap = 0
+    for r in rows:
+        bitmap |= 1 << (date.fromisoformat(r["date"]) - start).days
+    return start, bitmap
+
+
+def get_attendance_report(branch=None, start_month=None, end_month=None):
+    # Months are "YYYY-MM"; without a range the running totals are used.
+    conn = get_db()
+    params = []
+    if start_month or end_month:
+        sql = """
+            SELECT u.name, u.branch,
+                   COALESCE(SUM(m.days), 0) AS attended_days,
+                   MAX(m.month) AS last_month
+            FROM users u
+            LEFT JOIN attendance_monthly m
+                   ON m.student_id = u.id AND m.month BETWEEN ? AND ?
+            WHERE u.role='student'
+        """
+        params += [start_month or "0000-00", end_month or "9999-99"]
+    else:
+        sql = """
+            SELECT u.name, u.branch,
+                   COALESCE(s.attended_days, 0) AS attended_days,
+                   s.last_attended
+            FROM users u
+            LEFT JOIN student_stats s ON s.student_id = u.id
+            WHERE u.role='student'
+        """
+    if branch:
+        sql += " AND u.branch=?"
+        params.append(branch)
+    sql += " GROUP BY u.id ORDER BY u.name"
+    return [dict(r) for r in conn.execute(sql, params).fetchall()]
 
 
 # -------- PERFORMANCE --------
-def get_performance():
+def get_performance(branch=None):
     conn = get_db()
-    return [dict(r) for r in conn.execute("""
-        SELECT u.name, u.branch, COUNT(c.id) AS completed_tasks
+    sql = """
+        SELECT u.name, u.branch, COALESCE(s.completed_count, 0) AS completed_tasks
         FROM users u
-        LEFT JOIN completed c ON u.id = c.student_id
+        LEFT JOIN student_stats s ON s.student_id = u.id
         WHERE u.role='student'
-        GROUP BY u.id
-    """).fetchall()]
+    """
+    params = []
+    if branch:
+        sql += " AND u.branch=?"
+        params.append(branch)
+    sql += " ORDER BY u.name"
+    return [dict(r) for r in conn.execute(sql, params).fetchall()]
 
 
-# -------- LIBRARY --------
-def add_library_item(title, description, file_path, uploaded_by, branch):
+def get_task_completion_stats(branch=None, after=None, limit=None):
+    # Counters come from task_stats (migration 15). Keyset pagination on
+    # (deadline, id), newest first: `after` is the last row's pair.
     conn = get_db()
-    conn.execute(
-        "INSERT INTO library (title, description, file_path, uploaded_by, branch, uploaded_at) VALUES (?,?,?,?,?,?)",
-        (title, description, file_path, uploaded_by, branch, datetime.now().isoformat())
+    where, params = [], []
+    if branch:
+        where.append("s.branch=?")
+        params.append(branch)
+    if after is not None:
+        where.append("(s.deadline, s.task_id) < (?, ?)")
+        params += list(after)
+
+    sql = """
+        SELECT t.id, t.title, t.deadline, t.assigned_to,
+               CASE WHEN t.assignee_type='student' THEN 1 ELSE COALESCE(b.students, 0) END AS assigned,
+               s.completed, s.on_time, s.late,
+               ROUND(100.0 * s.completed / NULLIF(
+                   CASE WHEN t.assignee_type='student' THEN 1 ELSE COALESCE(b.students, 0) END, 0
+               ), 1) AS completion_rate
+        FROM task_stats s
+        JOIN tasks t ON t.id = s.task_id
+        LEFT JOIN branch_stats b ON t.assignee_type='branch' AND b.branch = t.assignee_branch
+    """
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY s.deadline DESC, s.task_id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return [dict(r) for r in conn.execute(sql, params).fetchall()]
+
+
+def get_branch_completion_stats(branch=None):
+    # A branch is assigned each of its branch tasks once per student, plus
+    # the tasks given to its students individually.
+    conn = get_db()
+    sql = """
+        SELECT branch,
+               students * branch_tasks + student_tasks AS assigned,
+               completed, on_time, late,
+               ROUND(100.0 * completed / NULLIF(students * branch_tasks + student_tasks, 0), 1)
+                   AS completion_rate
+        FROM branch_stats
+        WHERE branch_tasks + student_tasks > 0
+    """
+    params = []
+    if branch:
+        sql += " AND branch=?"
+        params.append(branch)
+    sql += " ORDER BY branch"
+    return [dict(r) for r in conn.execute(sql, params).fetchall()]
+
+
+# -------- LIBRARY --------
+def add_library_item(title, description, file_path, uploaded_by, branch,
+                     blob_sha=None, file_name=None):
+    file_name = file_name or os.path.basename(file_path)
+    return _write(_add_library_item, (title, description, file_path, uploaded_by, branch,
+                                      os.path.getsize(file_path), blob_sha, file_name))
+
+
+def _add_library_item(conn, item):
+    title, description, file_path, uploaded_by, branch, file_size, blob_sha, file_name = item
+    now = datetime.now().isoformat()
+    cur = conn.execute(
+        """INSERT INTO library (title, description, file_path, uploaded_by, branch,
+                                uploaded_at, file_size, blob_sha, file_name)
+           VALUES (?,?,?,?,?,?,?,?,?)""",
+        (title, description, file_path, uploaded_by, branch,
+         now, file_size, blob_sha, file_name)
     )
-    conn.commit()
+    if file_name.lower().endswith(".pdf"):
+        conn.execute(
+            "INSERT INTO ingest_jobs (library_id, created_at, updated_at) VALUES (?,?,?)",
+            (cur.lastrowid, now, now)
+        )
+    return cur.lastrowid
+
+
+LIBRARY_COLUMNS = """
+    l.id, l.title, l.description, l.file_path, l.uploaded_by, l.branch,
+    l.uploaded_at, l.file_size, l.blob_sha,
+    COALESCE(l.file_name, l.file_path) AS file_name,
+    COALESCE(u.name, 'Unknown') AS uploader_name
+"""
 
 
 def get_library_items(branch=None):
     conn = get_db()
+    sql = f"SELECT {LIBRARY_COLUMNS} FROM library l LEFT JOIN users u ON u.id = l.uploaded_by"
     if branch:
         rows = conn.execute(
-            "SELECT * FROM library WHERE branch=? OR branch='ALL' ORDER BY id DESC",
+            sql + " WHERE l.branch=? OR l.branch='ALL' ORDER BY l.id DESC",
             (branch,)
         ).fetchall()
     else:
-        rows = conn.execute("SELECT * FROM library ORDER BY id DESC").fetchall()
+        rows = conn.execute(sql + " ORDER BY l.id DESC").fetchall()
     return [dict(r) for r in rows]
 
 
-def delete_library_item(lib_id):
+def search_library(query, branch=None, limit=50):
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return get_library_items(branch)[:limit]
+
     conn = get_db()
+    params = []
+    if HAS_FTS:
+        # Every term must match, each as a prefix; title hits weigh most.
+        sql = f"""
+            SELECT {LIBRARY_COLUMNS}
+            FROM library_fts f
+            JOIN library l ON l.id = f.rowid
+            LEFT JOIN users u ON u.id = l.uploaded_by
+            WHERE library_fts MATCH ?
+        """
+        params.append(" ".join(f'"{t}"*' for t in terms))
+        order = "bm25(library_fts, 10.0, 2.0, 1.0)"
+    else:
+        sql = f"""
+            SELECT {LIBRARY_COLUMNS}
+            FROM library l
+            LEFT JOIN users u ON u.id = l.uploaded_by
+            WHERE 1=1
+        """
+        for t in terms:
+            sql += " AND (l.title LIKE ? OR l.description LIKE ? OR l.body_text LIKE ?)"
+            params += [f"%{t}%"] * 3
+        order = "l.id DESC"
+
+    if branch:
+        sql += " AND (l.branch=? OR l.branch='ALL')"
+        params.append(branch)
+    sql += f" ORDER BY {order} LIMIT ?"
+    params.append(limit)
+
+    return [dict(r) for r in conn.execute(sql, params).fetchall()]
+
+
+def delete_library_item(lib_id):
+    _write(_delete_library_item, lib_id)
+    collect_blobs()
+
+
+def _delete_library_item(conn, lib_id):
     conn.execute("DELETE FROM library WHERE id=?", (lib_id,))
+    conn.execute("DELETE FROM ingest_jobs WHERE library_id=?", (lib_id,))
+
+
+# -------- BLOBS --------
+def put_blob(src):
+    # Stores an upload and registers it unreferenced right away, so a file
+    # whose row never gets inserted is still collected once the grace
+    # period is over; the row's trigger takes the count to 1.
+    sha, size, path = storage.put_stream(src)
+    _write(
+        _execute,
+        """INSERT INTO blobs (sha256, size, refcount, created_at) VALUES (?, ?, 0, datetime('now'))
+           ON CONFLICT (sha256) DO UPDATE SET size = COALESCE(size, excluded.size)""",
+        (sha, size)
+    )
+    return sha, size, path
+
+
+def collect_blobs():
+    # Removes files no row references any more (see storage.GC_GRACE_SECONDS).
+    conn = get_db()
+    removed = [r["sha256"] for r in conn.execute(
+        "SELECT sha256 FROM blobs WHERE refcount <= 0"
+    ).fetchall() if storage.remove_blob(r["sha256"])]
+    if removed:
+        _write(_execute_many, "DELETE FROM blobs WHERE sha256=? AND refcount <= 0",
+               [(sha,) for sha in removed])
+    return len(removed)
+
+
+# -------- EMAIL OUTBOX --------
+def enqueue_email(to, subject, body):
+    now = datetime.now().isoformat()
+    _write(_execute,
+           "INSERT INTO outbox (recipient, subject, body, created_at, next_attempt_at) VALUES (?,?,?,?,?)",
+           (to, subject, body, now, now))
+
+
+def claim_outbox_batch(claim, limit, stale_before):
+    # Also takes over rows whose claim is older than stale_before: the
+    # dispatcher that held them is gone (rows from before migration 16
+    # have no claimed_at).
+    conn = get_db()
+    now = datetime.now().isoformat()
+    conn.execute(
+        """UPDATE outbox SET status='sending', claim=?, claimed_at=?
+           WHERE id IN (SELECT id FROM outbox
+                        WHERE (status='pending' AND next_attempt_at <= ?)
+                           OR (status='sending' AND claim IS NOT ?
+                               AND (claimed_at IS NULL OR claimed_at < ?))
+                        ORDER BY id LIMIT ?)""",
+        (claim, now, now, claim, stale_before.isoformat(), limit)
+    )
+    conn.commit()
+    return [dict(r) for r in conn.execute(
+        "SELECT id, recipient, subject, body, attempts FROM outbox WHERE claim=? AND status='sending'",
+        (claim,)
+    ).fetchall()]
+
+
+def mark_outbox_sent(ids):
+    conn = get_db()
+    conn.executemany(
+        "UPDATE outbox SET status='sent', sent_at=?, attempts=attempts+1, last_error=NULL WHERE id=?",
+        [(datetime.now().isoformat(), i) for i in ids]
+    )
+    conn.commit()
+
+
+def mark_outbox_failed(msg_id, error, retry_at=None):
+    # retry_at=None gives up on the message for good.
+    conn = get_db()
+    conn.execute(
+        """UPDATE outbox SET status=?, attempts=attempts+1, last_error=?, next_attempt_at=?
+           WHERE id=?""",
+        ("pending" if retry_at else "failed", error,
+         retry_at.isoformat() if retry_at else None, msg_id)
+    )
+    conn.commit()
+
+
+def release_outbox(ids):
+    conn = get_db()
+    conn.executemany("UPDATE outbox SET status='pending' WHERE id=?", [(i,) for i in ids])
+    conn.commit()
+
+
+def get_outbox_stats():
+    conn = get_db()
+    return {r["status"]: r["n"] for r in conn.execute(
+        "SELECT status, COUNT(*) AS n FROM outbox GROUP BY status"
+    )}
+
+
+# -------- ROSTER IMPORT / EXPORT --------
+EXPORT_FETCH_SIZE = 500
+
+
+def existing_emails(emails):
+    conn = get_db()
+    emails = list(emails)
+    if not emails:
+        return set()
+    return {r["email"] for r in conn.execute(
+        f"SELECT email FROM users WHERE email IN ({','.join('?' * len(emails))})", emails
+    )}
+
+
+def insert_users(rows):
+    # rows: (name, email, password_hash, role, branch, phone, dob); rows
+    # whose email already exists are skipped. One transaction per call.
+    inserted = _write(
+        _execute_many,
+        """INSERT OR IGNORE INTO users (name, email, password, role, branch, phone, dob)
+           VALUES (?,?,?,?,?,?,?)""",
+        rows
+    )
+    invalidate("users")
+    return inserted
+
+
+def _iter_query(sql, params=()):
+    # Streams rows as tuples without loading the whole result.
+    cur = get_db().execute(sql, params)
+    cur.row_factory = None
+    while rows := cur.fetchmany(EXPORT_FETCH_SIZE):
+        yield from rows
+
+
+USER_EXPORT_COLUMNS = ("id", "name", "email", "role", "branch", "phone", "dob")
+
+
+def iter_users(role=None, branch=None):
+    sql = f"SELECT {', '.join(USER_EXPORT_COLUMNS)} FROM users WHERE 1=1"
+    params = []
+    if role:
+        sql += " AND role=?"
+        params.append(role)
+    if branch:
+        sql += " AND branch=?"
+        params.append(branch)
+    return _iter_query(sql + " ORDER BY role, branch, name, id", params)
+
+
+ATTENDANCE_EXPORT_COLUMNS = ("student_id", "name", "branch", "date")
+
+
+def iter_attendance(branch=None, start=None, end=None):
+    # Ordered to follow idx_users_role_branch (role, branch, name) and then
+    # each student's days in the (student_id, date) index, so SQLite never
+    # sorts the attendance rows.
+    sql = """
+        SELECT u.id, u.name, u.branch, a.date
+        FROM users u JOIN attendance a ON a.student_id = u.id
+        WHERE u.role='student' AND a.date BETWEEN ? AND ?
+    """
+    params = [start.isoformat() if start else "0000-00-00",
+              end.isoformat() if end else "9999-99-99"]
+    if branch:
+        sql += " AND u.branch=?"
+        params.append(branch)
+    return _iter_query(sql + " ORDER BY u.branch, u.name, u.id, a.date", params)
+
+
+PERFORMANCE_EXPORT_COLUMNS = (
+    "student_id", "name", "branch", "completed_tasks", "attended_days", "last_attended"
+)
+
+
+def iter_performance(branch=None):
+    sql = """
+        SELECT u.id, u.name, u.branch,
+               COALESCE(s.completed_count, 0), COALESCE(s.attended_days, 0), s.last_attended
+        FROM users u
+        LEFT JOIN student_stats s ON s.student_id = u.id
+        WHERE u.role='student'
+    """
+    params = []
+    if branch:
+        sql += " AND u.branch=?"
+        params.append(branch)
+    return _iter_query(sql + " ORDER BY u.branch, u.name, u.id", params)
+
+
+# -------- INGESTION --------
+def claim_ingest_job(stale_before):
+    # A 'running' job whose heartbeat (updated_at) is older than
+    # stale_before belonged to a worker that died; it is taken over.
+    conn = get_db()
+    stale = stale_before.isoformat()
+    while True:
+        row = conn.execute("""
+            SELECT j.id, j.library_id, j.attempts, l.file_path
+            FROM ingest_jobs j JOIN library l ON l.id = j.library_id
+            WHERE j.status='pending' OR (j.status='running' AND j.updated_at < ?)
+            ORDER BY j.id LIMIT 1
+        """, (stale,)).fetchone()
+        if not row:
+            return None
+        cur = conn.execute(
+            """UPDATE ingest_jobs SET status='running', attempts=attempts+1, updated_at=?
+               WHERE id=? AND (status='pending' OR (status='running' AND updated_at < ?))""",
+            (datetime.now().isoformat(), row["id"], stale)
+        )
+        conn.commit()
+        if cur.rowcount:
+            return dict(row)
+
+
+def update_ingest_progress(job_id, pages_done, pages_total):
+    conn = get_db()
+    conn.execute(
+        "UPDATE ingest_jobs SET pages_done=?, pages_total=?, updated_at=? WHERE id=?",
+        (pages_done, pages_total, datetime.now().isoformat(), job_id)
+    )
     conn.commit()
 
 
+def finish_ingest_job(job_id, library_id, text):
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE library SET body_text=? WHERE id=?", (text, library_id))
+        conn.execute(
+            "UPDATE ingest_jobs SET status='done', error=NULL, updated_at=? WHERE id=?",
+            (datetime.now().isoformat(), job_id)
+        )
+
+
+def fail_ingest_job(job_id, error, retry):
+    conn = get_db()
+    conn.execute(
+        "UPDATE ingest_jobs SET status=?, error=?, updated_at=? WHERE id=?",
+        ("pending" if retry else "failed", error, datetime.now().isoformat(), job_id)
+    )
+    conn.commit()
+
+
+def get_ingest_status(library_ids):
+    if not library_ids:
+        return {}
+    conn = get_db()
+    marks = ",".join("?" * len(library_ids))
+    rows = conn.execute(
+        f"""SELECT library_id, status, pages_done, pages_total, error
+            FROM ingest_jobs WHERE library_id IN ({marks})""",
+        list(library_ids)
+    ).fetchall()
+    return {r["library_id"]: dict(r) for r in rows}
+
+
+# Every public function is timed (see instrument.py); the pool plumbing
+# runs on every call and is left out.
+instrument.instrument_module(
+    globals(), "db", skip={"get_db", "close_db", "close_all", "get_pool_stats", "parse_assignee"}
+)
+
 init_db()
+writer.start(_connect)
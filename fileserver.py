@@ -0,0 +1,183 @@
+import base64
+import email.utils
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlsplit
+
+import storage
+from db import get_secret
+
+# Small static-file endpoint for downloads. Streamlit pages only render a
+# signed link; the file is read when the browser asks for it, in ranges,
+# straight from a memory map. Blobs get their content hash as a strong
+# ETag, so repeat downloads of the same PDF are answered with 304.
+SERVE_ROOTS = ("blobs", "library_files", "submissions", "profile_photos", "exports")
+LINK_TTL = 6 * 3600
+SEND_CHUNK = 256 * 1024
+
+_start_lock = threading.Lock()
+_server = None
+_public_url = None
+
+
+def start_server(host, port, public_url):
+    global _server, _public_url
+    with _start_lock:
+        if _public_url is not None:
+            return
+        _public_url = public_url.rstrip("/")
+        try:
+            _server = ThreadingHTTPServer((host, int(port)), _Handler)
+        except OSError:
+            # Another Streamlit process on this host already serves the port.
+            return
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="file-server", daemon=True).start()
+
+
+def enabled():
+    return _public_url is not None
+
+
+def _sign(payload):
+    return hmac.new(get_secret("file_links").encode(), payload, hashlib.sha256).hexdigest()
+
+
+def file_url(path, file_name):
+    payload = base64.urlsafe_b64encode(json.dumps(
+        {"p": path, "e": int(time.time()) + LINK_TTL}
+    ).encode())
+    return f"{_public_url}/f/{payload.decode()}/{_sign(payload)}/{quote(file_name)}"
+
+
+def _verify(payload, signature):
+    if not hmac.compare_digest(_sign(payload.encode()), signature):
+        return None
+    data = json.loads(base64.urlsafe_b64decode(payload))
+    if data["e"] < time.time():
+        return None
+    path = os.path.normpath(data["p"])
+    if path.split(os.sep)[0] not in SERVE_ROOTS:
+        return None
+    return path
+
+
+def _etag(path, stat):
+    name = os.path.basename(path)
+    if path.startswith(storage.BLOB_ROOT + os.sep) and re.fullmatch(r"[0-9a-f]{64}", name):
+        return f'"{name}"'
+    return f'"{stat.st_size:x}-{int(stat.st_mtime):x}"'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def _serve(self, head):
+        parts = urlsplit(self.path).path.split("/")
+        if len(parts) != 5 or parts[1] != "f":
+            return self._empty(404)
+        try:
+            path = _verify(parts[2], parts[3])
+        except ValueError:
+            path = None
+        if path is None:
+            return self._empty(403)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return self._empty(404)
+
+        etag = _etag(path, stat)
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "private, max-age=86400",
+            "Content-Disposition": f"attachment; filename*=UTF-8''{parts[4]}",
+        }
+
+        if self._not_modified(etag, stat):
+            return self._empty(304, headers)
+
+        size = stat.st_size
+        start, end, status = 0, size - 1, 200
+        byte_range = self.headers.get("Range")
+        if byte_range and self.headers.get("If-Range", etag) == etag:
+            parsed = _parse_range(byte_range, size)
+            if parsed is None:
+                headers["Content-Range"] = f"bytes */{size}"
+                return self._empty(416, headers)
+            start, end = parsed
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(max(end - start + 1, 0)))
+        self.end_headers()
+
+        if head or size == 0:
+            return
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = start
+            while pos <= end:
+                stop = min(pos + SEND_CHUNK, end + 1)
+                self.wfile.write(mm[pos:stop])
+                pos = stop
+
+    def _not_modified(self, etag, stat):
+        inm = self.headers.get("If-None-Match")
+        if inm is not None:
+            return etag in [t.strip() for t in inm.split(",")] or inm.strip() == "*"
+        ims = self.headers.get("If-Modified-Since")
+        if ims:
+            try:
+                return int(stat.st_mtime) <= email.utils.parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _empty(self, status, headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def _parse_range(value, size):
+    # Only single ranges are supported; that is all browsers and download
+    # managers use for resuming.
+    m = re.fullmatch(r"bytes=(\d*)-(\d*)", value.strip())
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+    else:
+        start = max(size - int(m.group(2)), 0)
+        end = size - 1
+    end = min(end, size - 1)
+    if start > end:
+        return None
+    return start, end
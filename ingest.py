@@ -0,0 +1,106 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+import pdftext
+from db import (
+    claim_ingest_job, update_ingest_progress, finish_ingest_job,
+    fail_ingest_job,
+)
+
+# Background extraction of library PDF text. Jobs live in the ingest_jobs
+# table, so uploads return immediately and work survives restarts.
+PAGES_PER_CHUNK = 20
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 5
+WORKERS = int(os.environ.get("PLANNER_INGEST_WORKERS", "2"))
+# A running job's updated_at is refreshed at least every HEARTBEAT; one
+# silent for LEASE is reclaimed by any worker (its process died).
+HEARTBEAT = timedelta(seconds=60)
+LEASE = timedelta(minutes=10)
+
+log = logging.getLogger("planner.ingest")
+
+_wakeup = threading.Event()
+_start_lock = threading.Lock()
+_thread = None
+
+
+def start_worker():
+    global _thread
+    with _start_lock:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_run, name="pdf-ingest", daemon=True)
+        _thread.start()
+
+
+def notify():
+    _wakeup.set()
+
+
+def _new_pool():
+    # Spawned processes only import pdftext, not the Streamlit app.
+    return ProcessPoolExecutor(
+        max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _run():
+    pool = _new_pool()
+    while True:
+        try:
+            job = claim_ingest_job(datetime.now() - LEASE)
+            if job is None:
+                _wakeup.wait(POLL_SECONDS)
+                _wakeup.clear()
+                continue
+            try:
+                text = _extract(pool, job)
+            except BrokenProcessPool as e:
+                # A worker died (OOM, a crash on a bad PDF) and the pool is
+                # unusable from now on; replace it for the jobs that follow.
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = _new_pool()
+                fail_ingest_job(job["id"], str(e)[:500], job["attempts"] + 1 < MAX_ATTEMPTS)
+            except Exception as e:
+                fail_ingest_job(job["id"], str(e)[:500], job["attempts"] + 1 < MAX_ATTEMPTS)
+            else:
+                finish_ingest_job(job["id"], job["library_id"], text)
+        except Exception:
+            # e.g. "database is locked"; a job left 'running' is picked up
+            # again once its lease runs out.
+            log.exception("pdf ingest failed; retrying in %ss", POLL_SECONDS)
+            _wakeup.wait(POLL_SECONDS)
+            _wakeup.clear()
+
+
+def _result(future, job, done, total):
+    # Waits for one pool task, keeping the job's lease alive meanwhile.
+    while True:
+        try:
+            return future.result(timeout=HEARTBEAT.total_seconds())
+        except TimeoutError:
+            update_ingest_progress(job["id"], done, total)
+
+
+def _extract(pool, job):
+    path = job["file_path"]
+    total = _result(pool.submit(pdftext.count_pages, path), job, 0, None)
+    update_ingest_progress(job["id"], 0, total)
+
+    chunks = [
+        pool.submit(pdftext.extract_pages, path, start, min(start + PAGES_PER_CHUNK, total))
+        for start in range(0, total, PAGES_PER_CHUNK)
+    ]
+    pages, done = [], 0
+    for chunk in chunks:
+        texts = _result(chunk, job, done, total)
+        pages.extend(texts)
+        done += len(texts)
+        update_ingest_progress(job["id"], done, total)
+    return "\n".join(pages)
@@ -0,0 +1,235 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+
+# Lightweight timing for hot paths. Samples (duration, row count) are kept
+# per (kind, name) in fixed-size ring buffers, so memory stays bounded and
+# percentiles reflect recent traffic. Kinds in use: "page" (a view in
+# app.main_layout), "db" (a db.py function), "sql" (one statement),
+# "writer" (a group-commit batch; rows = operations) and "io" (file reads
+# and writes).
+RING_SIZE = int(os.environ.get("PLANNER_METRICS_SAMPLES", "1024"))
+EXPORT_INTERVAL = 15
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+_samples = {}
+_totals = {}
+
+_export_lock = threading.Lock()
+_export_path = None
+
+
+def record(kind, name, ms, rows=None, error=False):
+    key = (kind, name)
+    with _lock:
+        ring = _samples.get(key)
+        if ring is None:
+            ring = _samples[key] = deque(maxlen=RING_SIZE)
+            _totals[key] = [0, 0, 0.0]  # calls, errors, total ms
+        ring.append((ms, rows))
+        totals = _totals[key]
+        totals[0] += 1
+        totals[1] += error
+        totals[2] += ms
+
+
+def _count_rows(result):
+    if isinstance(result, (list, dict)):
+        return len(result)
+    return None
+
+
+@contextmanager
+def span(kind, name):
+    # Yields a dict; set "rows" on it to record a row count.
+    info = {"rows": None}
+    start = time.perf_counter()
+    error = False
+    try:
+        yield info
+    except Exception:
+        # Streamlit's rerun/stop signals are BaseExceptions, not failures
+        error = True
+        raise
+    finally:
+        record(kind, name, (time.perf_counter() - start) * 1000, info["rows"], error)
+
+
+def timed(kind, name=None):
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                record(kind, label, (time.perf_counter() - start) * 1000, error=True)
+                raise
+            record(kind, label, (time.perf_counter() - start) * 1000, _count_rows(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def instrument_module(namespace, kind, skip=()):
+    # Wraps every public function defined in the module owning `namespace`
+    # (pass globals()). Callers that import names afterwards get the
+    # wrapped versions.
+    module = namespace["__name__"]
+    for attr, value in list(namespace.items()):
+        if (attr.startswith("_") or attr in skip or not callable(value)
+                or getattr(value, "__module__", None) != module
+                or isinstance(value, type)):
+            continue
+        namespace[attr] = timed(kind, attr)(value)
+
+
+# ------ SQL ------
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    # One name per statement shape: whitespace collapsed and placeholder
+    # lists of any length folded together.
+    sql = re.sub(r"\s+", " ", sql).strip()
+    return re.sub(r"\?(?:\s*,\s*\?)+", "?, ...", sql)
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Times execute(), which in SQLite plans the statement and runs it up to
+    # the first row; for DML the affected row count is recorded. Rows read
+    # by SELECTs are attributed to the calling db.py function.
+    def _timed(self, method, sql, parameters):
+        conn = self.connection
+        if conn.before_statement:
+            conn.before_statement(conn)
+        start = time.perf_counter()
+        try:
+            method(sql, parameters)
+        except Exception:
+            record("sql", normalize_sql(sql), (time.perf_counter() - start) * 1000, error=True)
+            raise
+        ms = (time.perf_counter() - start) * 1000
+        rows = self.rowcount if self.rowcount >= 0 else None
+        record("sql", normalize_sql(sql), ms, rows)
+        if conn.after_statement:
+            conn.after_statement(conn, sql, parameters, ms, rows)
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+
+class TimedConnection(sqlite3.Connection):
+    # sqlite3.connect(..., factory=TimedConnection). The statement hooks are
+    # set per connection by slowlog.attach().
+    before_statement = None
+    after_statement = None
+
+    def execute(self, sql, parameters=()):
+        return self.cursor(TimedCursor).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor(TimedCursor).executemany(sql, seq_of_parameters)
+
+
+# ------ SUMMARIES ------
+def _quantile(values, q):
+    k = max(0, min(len(values) - 1, round(q * len(values)) - 1))
+    return values[k]
+
+
+def summary(kind=None):
+    with _lock:
+        items = [(key, list(ring), list(_totals[key])) for key, ring in _samples.items()
+                 if kind is None or key[0] == kind]
+
+    out = []
+    for (k, name), ring, (calls, errors, total_ms) in items:
+        durations = sorted(ms for ms, _ in ring)
+        rows = [r for _, r in ring if r is not None]
+        out.append({
+            "kind": k,
+            "name": name,
+            "calls": calls,
+            "errors": errors,
+            "total_ms": round(total_ms, 1),
+            "p50_ms": round(_quantile(durations, 0.5), 3),
+            "p95_ms": round(_quantile(durations, 0.95), 3),
+            "p99_ms": round(_quantile(durations, 0.99), 3),
+            "max_ms": round(durations[-1], 3),
+            "avg_rows": round(sum(rows) / len(rows), 1) if rows else None,
+        })
+    out.sort(key=lambda r: r["total_ms"], reverse=True)
+    return out
+
+
+def reset():
+    with _lock:
+        _samples.clear()
+        _totals.clear()
+
+
+# ------ PROMETHEUS EXPORT ------
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def prometheus_text():
+    with _lock:
+        items = [(key, sorted(ms for ms, _ in ring), list(_totals[key]))
+                 for key, ring in _samples.items()]
+
+    lines = [
+        "# HELP planner_duration_milliseconds Recent call durations by kind and name.",
+        "# TYPE planner_duration_milliseconds summary",
+    ]
+    errors = [
+        "# HELP planner_errors_total Calls that raised, by kind and name.",
+        "# TYPE planner_errors_total counter",
+    ]
+    for (kind, name), durations, (calls, failed, total_ms) in items:
+        labels = f'kind="{_label(kind)}",name="{_label(name)}"'
+        for q in QUANTILES:
+            lines.append(f'planner_duration_milliseconds{{{labels},quantile="{q}"}} '
+                         f"{_quantile(durations, q):.3f}")
+        lines.append(f"planner_duration_milliseconds_sum{{{labels}}} {total_ms:.3f}")
+        lines.append(f"planner_duration_milliseconds_count{{{labels}}} {calls}")
+        errors.append(f"planner_errors_total{{{labels}}} {failed}")
+    return "\n".join(lines + errors) + "\n"
+
+
+def export(path):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+
+def start_exporter(path, interval=EXPORT_INTERVAL):
+    # Rewrites `path` every `interval` seconds for a node_exporter textfile
+    # collector (or anything else that scrapes files).
+    global _export_path
+    with _export_lock:
+        if _export_path is not None:
+            return
+        _export_path = path
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                export(path)
+            except OSError:
+                pass
+
+    threading.Thread(target=loop, name="metrics-exporter", daemon=True).start()
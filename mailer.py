@@ -0,0 +1,152 @@
+import logging
+import smtplib
+import threading
+import uuid
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+
+from db import (
+    claim_outbox_batch, mark_outbox_sent, mark_outbox_failed,
+    release_outbox,
+)
+
+# Background dispatcher for the outbox table. One authenticated SMTP
+# connection is kept open and reused across batches; failed messages are
+# retried with exponential backoff.
+#
+# For local testing point it at a stand-in server, e.g.
+#   python -m aiosmtpd -n -l localhost:1025
+# with SMTP_HOST=localhost, SMTP_PORT=1025, SMTP_SSL=false.
+BATCH_SIZE = 50
+POLL_SECONDS = 10
+IDLE_CLOSE_SECONDS = 60
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = timedelta(seconds=30)
+BACKOFF_MAX = timedelta(hours=1)
+# Rows claimed longer ago than this are taken over from a dispatcher that
+# died; well above the time a batch can take (BATCH_SIZE sends with a 30 s
+# socket timeout each).
+LEASE = timedelta(minutes=30)
+
+log = logging.getLogger("planner.mailer")
+
+_wakeup = threading.Event()
+_start_lock = threading.Lock()
+_thread = None
+
+
+def start_dispatcher(host, port, user=None, password=None, use_ssl=True, sender=None):
+    global _thread
+    with _start_lock:
+        if _thread is not None:
+            return
+        config = {
+            "host": host, "port": int(port), "user": user, "password": password,
+            "use_ssl": use_ssl, "sender": sender or user,
+        }
+        _thread = threading.Thread(target=_run, args=(config,), name="mail-dispatch", daemon=True)
+        _thread.start()
+
+
+def enabled():
+    # False when no SMTP account is configured; nothing should be queued then.
+    return _thread is not None
+
+
+def notify():
+    _wakeup.set()
+
+
+def _connect(config):
+    cls = smtplib.SMTP_SSL if config["use_ssl"] else smtplib.SMTP
+    server = cls(config["host"], config["port"], timeout=30)
+    if config["user"]:
+        server.login(config["user"], config["password"])
+    return server
+
+
+def _close(server):
+    try:
+        server.quit()
+    except smtplib.SMTPException:
+        server.close()
+    except OSError:
+        pass
+
+
+def _backoff(attempts):
+    return min(BACKOFF_BASE * (2 ** attempts), BACKOFF_MAX)
+
+
+def _run(config):
+    claim = uuid.uuid4().hex
+    server, idle_since = None, None
+
+    while True:
+        try:
+            batch = claim_outbox_batch(claim, BATCH_SIZE, datetime.now() - LEASE)
+            if not batch:
+                if server and idle_since and datetime.now() - idle_since > timedelta(seconds=IDLE_CLOSE_SECONDS):
+                    _close(server)
+                    server = None
+                idle_since = idle_since or datetime.now()
+                _wakeup.wait(POLL_SECONDS)
+                _wakeup.clear()
+                continue
+
+            idle_since = None
+            server = _send_batch(config, server, batch)
+        except Exception:
+            # e.g. "database is locked"; rows left in 'sending' under this
+            # claim are picked up again by the next claim_outbox_batch().
+            log.exception("mail dispatch failed; retrying in %ss", POLL_SECONDS)
+            if server:
+                _close(server)
+                server = None
+            _wakeup.wait(POLL_SECONDS)
+            _wakeup.clear()
+
+
+def _retry_later(msg, error):
+    attempts = msg["attempts"] + 1
+    retry_at = datetime.now() + _backoff(attempts) if attempts < MAX_ATTEMPTS else None
+    mark_outbox_failed(msg["id"], str(error)[:500], retry_at)
+
+
+def _send_batch(config, server, batch):
+    if server is None:
+        try:
+            server = _connect(config)
+        except (smtplib.SMTPException, OSError) as e:
+            for msg in batch:
+                _retry_later(msg, e)
+            return None
+
+    sent, unsent = [], []
+    for i, msg in enumerate(batch):
+        mime = MIMEText(msg["body"])
+        mime["Subject"], mime["From"], mime["To"] = msg["subject"], config["sender"], msg["recipient"]
+
+        try:
+            try:
+                server.sendmail(config["sender"], [msg["recipient"]], mime.as_string())
+            except smtplib.SMTPServerDisconnected:
+                # Reused connection timed out on the server side; reconnect once.
+                server = _connect(config)
+                server.sendmail(config["sender"], [msg["recipient"]], mime.as_string())
+            sent.append(msg["id"])
+        except smtplib.SMTPRecipientsRefused as e:
+            mark_outbox_failed(msg["id"], str(e)[:500])
+        except (smtplib.SMTPException, OSError) as e:
+            _retry_later(msg, e)
+            if not isinstance(e, smtplib.SMTPResponseException):
+                _close(server)
+                server = None
+                unsent = [m["id"] for m in batch[i + 1:]]
+                break
+
+    if unsent:
+        release_outbox(unsent)
+    if sent:
+        mark_outbox_sent(sent)
+    return server
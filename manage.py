@@ -0,0 +1,137 @@
+import argparse
+import os
+import sys
+from datetime import date
+
+import db
+import roster
+import slowlog
+import thumbnails
+from cache import invalidate
+
+
+def rebuild_reports(args):
+    db.rebuild_reports()
+    print("Report summaries rebuilt.")
+
+
+def schema_version(args):
+    applied = db.get_db().execute(
+        "SELECT version, name, applied_at FROM schema_version ORDER BY version"
+    ).fetchall()
+    for r in applied:
+        print(f"{r['version']:>4}  {r['name']:<28} {r['applied_at']}")
+    print(f"Schema at version {applied[-1]['version'] if applied else 0}.")
+
+
+def slow_queries(args):
+    rows = slowlog.read_log(args.log)
+    if not rows:
+        print(f"No slow queries in {args.log}.")
+    for r in rows[:args.top]:
+        print(f"{r['count']:>6}x  total {r['total_ms']:>10.1f} ms  max {r['max_ms']:>8.1f} ms  {r['statement'][:100]}")
+        for scan in r["full_scans"]:
+            print(f"{'':>10}full scan: {scan}")
+
+
+def import_roster(args):
+    with open(args.file, "rb") as f:
+        result = roster.import_roster(
+            f, args.file, args.branches, args.role,
+            progress=lambda r: print(f"{r['read']} rows read, {r['inserted']} added", file=sys.stderr)
+        )
+    for e in result["errors"]:
+        print(f"line {e['line']}: {e['error']}", file=sys.stderr)
+    if result["credentials"]:
+        with open(args.passwords_out, "w", newline="") as out:
+            out.write(roster.credentials_csv(result["credentials"]))
+        print(f"Generated passwords written to {args.passwords_out}")
+    print(f"{result['inserted']} added, {result['skipped']} already registered, "
+          f"{len(result['errors'])} rejected (of {result['read']} rows).")
+
+
+def export(args):
+    filters = {"branch": args.branch} if args.branch else {}
+    if args.start:
+        filters["start"] = date.fromisoformat(args.start)
+    if args.end:
+        filters["end"] = date.fromisoformat(args.end)
+    if args.output == "-":
+        roster.export_csv(args.kind, sys.stdout, **filters)
+    else:
+        with open(args.output, "w", newline="", encoding="utf-8") as out:
+            count = roster.export_csv(args.kind, out, **filters)
+        print(f"{count} rows written to {args.output}")
+
+
+def backfill_avatars(args):
+    # Moves photos saved by older versions into the blob store and
+    # generates their thumbnails.
+    conn = db.get_db()
+    rows = conn.execute(
+        "SELECT id, photo_path, photo_sha FROM users WHERE photo_path IS NOT NULL"
+    ).fetchall()
+    done = 0
+    for r in rows:
+        if not os.path.exists(r["photo_path"]):
+            continue
+        sha, path = r["photo_sha"], r["photo_path"]
+        if not sha:
+            with open(path, "rb") as f:
+                sha, _, path = db.put_blob(f)
+        try:
+            thumbnails.make_thumbnails(path, sha)
+        except ValueError:
+            print(f"Skipping user {r['id']}: unreadable photo")
+            continue
+        conn.execute("UPDATE users SET photo_path=?, photo_sha=? WHERE id=?", (path, sha, r["id"]))
+        conn.commit()
+        done += 1
+    invalidate("users")
+    print(f"Thumbnails ready for {done} users.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Planner maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser(
+        "rebuild-reports", help="Recompute student_stats, attendance_monthly, task_stats and branch_stats"
+    ).set_defaults(func=rebuild_reports)
+
+    sub.add_parser(
+        "schema-version", help="List applied schema migrations"
+    ).set_defaults(func=schema_version)
+
+    p = sub.add_parser("slow-queries", help="Summarize the slow-query log by statement")
+    p.add_argument("--log", default=slowlog.LOG_PATH)
+    p.add_argument("--top", type=int, default=20)
+    p.set_defaults(func=slow_queries)
+
+    p = sub.add_parser("import-roster", help="Add users from a CSV or XLSX roster")
+    p.add_argument("file")
+    p.add_argument("--role", choices=roster.ROLES, default="student",
+                   help="role for rows without a role column")
+    p.add_argument("--branches", nargs="*", help="accepted branch names (default: any)")
+    p.add_argument("--passwords-out", default="roster-passwords.csv",
+                   help="where to write passwords generated for rows without one")
+    p.set_defaults(func=import_roster)
+
+    p = sub.add_parser("export", help="Stream a report as CSV")
+    p.add_argument("kind", choices=list(roster.EXPORTS))
+    p.add_argument("-o", "--output", default="-")
+    p.add_argument("--branch")
+    p.add_argument("--start", help="attendance only: first day (YYYY-MM-DD)")
+    p.add_argument("--end", help="attendance only: last day (YYYY-MM-DD)")
+    p.set_defaults(func=export)
+
+    sub.add_parser(
+        "backfill-avatars", help="Generate thumbnails for existing profile photos"
+    ).set_defaults(func=backfill_avatars)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
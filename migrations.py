@@ -0,0 +1,711 @@
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+import storage
+
+# Versioned schema migrations. Each migration runs once, in order, inside
+# its own IMMEDIATE transaction, and is recorded in schema_version.
+# Migrations are written to be idempotent so databases created by older
+# versions of init_db() (which applied parts of this schema ad hoc) upgrade
+# cleanly from version 0.
+
+
+def _columns(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn, table, column, decl):
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name=?", (name,)).fetchone() is not None
+
+
+# ------ 1: BASE TABLES ------
+def m001_base_tables(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        email TEXT UNIQUE,
+        password TEXT,
+        role TEXT,
+        branch TEXT,
+        phone TEXT,
+        dob TEXT,
+        photo_path TEXT
+    )
+    """)
+    _add_column(conn, "users", "phone", "TEXT")
+    _add_column(conn, "users", "dob", "TEXT")
+    _add_column(conn, "users", "photo_path", "TEXT")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT,
+        description TEXT,
+        deadline TEXT,
+        assigned_to TEXT,
+        created_by INTEGER,
+        pdf_path TEXT
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS completed (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER,
+        task_id INTEGER
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS attendance (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER,
+        date TEXT
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS library (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT,
+        description TEXT,
+        file_path TEXT,
+        uploaded_by INTEGER,
+        branch TEXT,
+        uploaded_at TEXT
+    )
+    """)
+    _add_column(conn, "library", "branch", "TEXT")
+    _add_column(conn, "library", "uploaded_at", "TEXT")
+
+
+# ------ 2: NORMALIZED TASK ASSIGNMENT ------
+def m002_task_assignees(conn):
+    # Replaces the "student:<id>" / "branch:<name>" encoding in assigned_to
+    _add_column(conn, "tasks", "assignee_type", "TEXT")
+    _add_column(conn, "tasks", "assignee_id", "INTEGER")
+    _add_column(conn, "tasks", "assignee_branch", "TEXT")
+
+    conn.execute("""
+    UPDATE tasks
+    SET assignee_type='student', assignee_id=CAST(substr(assigned_to, 9) AS INTEGER)
+    WHERE assignee_type IS NULL AND assigned_to LIKE 'student:%'
+    """)
+    conn.execute("""
+    UPDATE tasks
+    SET assignee_type='branch', assignee_branch=substr(assigned_to, 8)
+    WHERE assignee_type IS NULL AND assigned_to LIKE 'branch:%'
+    """)
+
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tasks_assignee_student
+    ON tasks (assignee_type, assignee_id, deadline, id)
+    """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tasks_assignee_branch
+    ON tasks (assignee_type, assignee_branch, deadline, id)
+    """)
+
+
+# ------ 3: ONE ATTENDANCE ROW PER STUDENT PER DAY ------
+def m003_attendance_unique(conn):
+    if _exists(conn, "ux_attendance_student_date"):
+        return
+    conn.execute("""
+    DELETE FROM attendance WHERE id NOT IN (
+        SELECT MIN(id) FROM attendance GROUP BY student_id, date
+    )
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_attendance_student_date")
+    conn.execute("""
+    CREATE UNIQUE INDEX ux_attendance_student_date
+    ON attendance (student_id, date)
+    """)
+
+
+# ------ 4: LIBRARY FILE SIZES ------
+def m004_library_file_size(conn):
+    _add_column(conn, "library", "file_size", "INTEGER")
+    for r in conn.execute("SELECT id, file_path FROM library WHERE file_size IS NULL").fetchall():
+        if r[1] and os.path.exists(r[1]):
+            conn.execute("UPDATE library SET file_size=? WHERE id=?", (os.path.getsize(r[1]), r[0]))
+
+
+# ------ 5: LIBRARY FULL-TEXT SEARCH ------
+def m005_library_fts(conn):
+    # Text extracted from uploaded PDFs by the background ingestion worker
+    _add_column(conn, "library", "body_text", "TEXT")
+
+    columns = _columns(conn, "library_fts") if _exists(conn, "library_fts") else set()
+    if columns and "body_text" not in columns:
+        # Index predates extracted PDF text; rebuild it with the extra column.
+        for trigger in ("library_fts_ai", "library_fts_ad", "library_fts_au"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute("DROP TABLE library_fts")
+        columns = set()
+
+    if not columns:
+        try:
+            conn.execute("""
+            CREATE VIRTUAL TABLE library_fts USING fts5(
+                title, description, body_text,
+                content='library', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+            """)
+        except sqlite3.OperationalError:
+            return  # SQLite built without FTS5; search falls back to LIKE
+        conn.execute("INSERT INTO library_fts(library_fts) VALUES('rebuild')")
+
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS library_fts_ai AFTER INSERT ON library BEGIN
+        INSERT INTO library_fts(rowid, title, description, body_text)
+        VALUES (new.id, new.title, new.description, new.body_text);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS library_fts_ad AFTER DELETE ON library BEGIN
+        INSERT INTO library_fts(library_fts, rowid, title, description, body_text)
+        VALUES ('delete', old.id, old.title, old.description, old.body_text);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS library_fts_au
+    AFTER UPDATE OF title, description, body_text ON library BEGIN
+        INSERT INTO library_fts(library_fts, rowid, title, description, body_text)
+        VALUES ('delete', old.id, old.title, old.description, old.body_text);
+        INSERT INTO library_fts(rowid, title, description, body_text)
+        VALUES (new.id, new.title, new.description, new.body_text);
+    END
+    """)
+
+
+# ------ 6: PDF INGESTION JOBS ------
+def m006_ingest_jobs(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ingest_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        library_id INTEGER,
+        status TEXT DEFAULT 'pending',
+        pages_done INTEGER DEFAULT 0,
+        pages_total INTEGER,
+        attempts INTEGER DEFAULT 0,
+        error TEXT,
+        created_at TEXT,
+        updated_at TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_library ON ingest_jobs (library_id)")
+
+
+# ------ 7: EMAIL OUTBOX ------
+def m007_outbox(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        recipient TEXT,
+        subject TEXT,
+        body TEXT,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at TEXT,
+        claim TEXT,
+        last_error TEXT,
+        created_at TEXT,
+        sent_at TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_claim ON outbox (claim)")
+
+
+# ------ 8: REPORT SUMMARIES ------
+def m008_report_summaries(conn):
+    # Per-student counters kept current by triggers on attendance/completed,
+    # so the Performance page never scans the fact tables.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS student_stats (
+        student_id INTEGER PRIMARY KEY,
+        completed_count INTEGER DEFAULT 0,
+        attended_days INTEGER DEFAULT 0,
+        last_attended TEXT
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS attendance_monthly (
+        student_id INTEGER,
+        month TEXT,
+        days INTEGER DEFAULT 0,
+        PRIMARY KEY (student_id, month)
+    ) WITHOUT ROWID
+    """)
+
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS attendance_stats_ai AFTER INSERT ON attendance BEGIN
+        INSERT INTO student_stats (student_id, attended_days, last_attended)
+        VALUES (new.student_id, 1, new.date)
+        ON CONFLICT (student_id) DO UPDATE SET
+            attended_days = attended_days + 1,
+            last_attended = MAX(COALESCE(last_attended, ''), excluded.last_attended);
+        INSERT INTO attendance_monthly (student_id, month, days)
+        VALUES (new.student_id, substr(new.date, 1, 7), 1)
+        ON CONFLICT (student_id, month) DO UPDATE SET days = days + 1;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS attendance_stats_ad AFTER DELETE ON attendance BEGIN
+        UPDATE student_stats SET
+            attended_days = attended_days - 1,
+            last_attended = (SELECT MAX(date) FROM attendance WHERE student_id = old.student_id)
+        WHERE student_id = old.student_id;
+        UPDATE attendance_monthly SET days = days - 1
+        WHERE student_id = old.student_id AND month = substr(old.date, 1, 7);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS completed_stats_ai AFTER INSERT ON completed BEGIN
+        INSERT INTO student_stats (student_id, completed_count)
+        VALUES (new.student_id, 1)
+        ON CONFLICT (student_id) DO UPDATE SET completed_count = completed_count + 1;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS completed_stats_ad AFTER DELETE ON completed BEGIN
+        UPDATE student_stats SET completed_count = completed_count - 1
+        WHERE student_id = old.student_id;
+    END
+    """)
+
+    rebuild_reports(conn)
+
+
+def rebuild_reports(conn):
+    conn.execute("DELETE FROM student_stats")
+    conn.execute("DELETE FROM attendance_monthly")
+    conn.execute("""
+        INSERT INTO student_stats (student_id, completed_count, attended_days, last_attended)
+        SELECT id,
+               (SELECT COUNT(*) FROM completed c WHERE c.student_id = u.id),
+               (SELECT COUNT(*) FROM attendance a WHERE a.student_id = u.id),
+               (SELECT MAX(date) FROM attendance a WHERE a.student_id = u.id)
+        FROM (SELECT student_id AS id FROM attendance
+              UNION SELECT student_id FROM completed) u
+    """)
+    conn.execute("""
+        INSERT INTO attendance_monthly (student_id, month, days)
+        SELECT student_id, substr(date, 1, 7), COUNT(*)
+        FROM attendance GROUP BY student_id, substr(date, 1, 7)
+    """)
+
+
+# ------ 9: ONE COMPLETION PER STUDENT PER TASK ------
+def m009_completed_unique(conn):
+    _add_column(conn, "completed", "completed_at", "TEXT")
+
+    # Repeated clicks used to insert duplicates; they are dropped (the
+    # summary triggers adjust the counters) before the unique index.
+    if not _exists(conn, "ux_completed_student_task"):
+        conn.execute("""
+        DELETE FROM completed WHERE id NOT IN (
+            SELECT MIN(id) FROM completed GROUP BY student_id, task_id
+        )
+        """)
+        conn.execute("""
+        CREATE UNIQUE INDEX ux_completed_student_task
+        ON completed (student_id, task_id)
+        """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_completed_task
+    ON completed (task_id, completed_at)
+    """)
+
+
+# ------ 10: PER-STUDENT SUBMISSIONS ------
+def m010_submissions(conn):
+    # One file per student per task (tasks.pdf_path only ever held the last upload)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS submissions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id INTEGER,
+        student_id INTEGER,
+        path TEXT,
+        size INTEGER,
+        sha256 TEXT,
+        uploaded_at TEXT,
+        UNIQUE (task_id, student_id)
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_student ON submissions (student_id)")
+
+    # Legacy uploads were saved as submissions/<student_id>/<task_id>.pdf
+    for task_id, pdf_path in conn.execute(
+        "SELECT id, pdf_path FROM tasks WHERE pdf_path IS NOT NULL"
+    ).fetchall():
+        m = re.search(r"submissions/(\d+)/(\d+)\.pdf$", pdf_path)
+        if not m or not os.path.exists(pdf_path):
+            continue
+        if conn.execute(
+            "SELECT 1 FROM submissions WHERE task_id=? AND student_id=?",
+            (task_id, int(m.group(1)))
+        ).fetchone():
+            continue
+        size, sha = storage.hash_file(pdf_path)
+        conn.execute(
+            """INSERT INTO submissions (task_id, student_id, path, size, sha256, uploaded_at)
+               VALUES (?,?,?,?,?,?)""",
+            (task_id, int(m.group(1)), pdf_path, size, sha,
+             datetime.fromtimestamp(os.path.getmtime(pdf_path)).isoformat())
+        )
+
+
+# ------ 11: BLOB REFERENCES ------
+def m011_blob_refs(conn):
+    # Uploads are stored by content hash (storage.py). Rows in library,
+    # submissions and users reference blobs; triggers keep the counts.
+    _add_column(conn, "library", "blob_sha", "TEXT")
+    _add_column(conn, "library", "file_name", "TEXT")
+    _add_column(conn, "submissions", "blob_sha", "TEXT")
+    _add_column(conn, "users", "photo_sha", "TEXT")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER,
+        refcount INTEGER DEFAULT 0,
+        created_at TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (refcount) WHERE refcount <= 0")
+
+    incref = """
+        INSERT INTO blobs (sha256, size, refcount, created_at)
+        VALUES ({sha}, {size}, 1, datetime('now'))
+        ON CONFLICT (sha256) DO UPDATE SET
+            refcount = refcount + 1, size = COALESCE(size, excluded.size);
+    """
+    decref = "UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = {sha};"
+
+    for table, column, size in (
+        ("library", "blob_sha", "new.file_size"),
+        ("submissions", "blob_sha", "new.size"),
+        ("users", "photo_sha", "NULL"),
+    ):
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_blob_ai AFTER INSERT ON {table}
+        WHEN new.{column} IS NOT NULL BEGIN
+            {incref.format(sha=f"new.{column}", size=size)}
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_blob_ad AFTER DELETE ON {table}
+        WHEN old.{column} IS NOT NULL BEGIN
+            {decref.format(sha=f"old.{column}")}
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_blob_au AFTER UPDATE OF {column} ON {table}
+        WHEN old.{column} IS NOT new.{column} BEGIN
+            {decref.format(sha=f"old.{column}")}
+            INSERT INTO blobs (sha256, size, refcount, created_at)
+            SELECT new.{column}, {size}, 1, datetime('now') WHERE new.{column} IS NOT NULL
+            ON CONFLICT (sha256) DO UPDATE SET
+                refcount = refcount + 1, size = COALESCE(size, excluded.size);
+        END
+        """)
+
+
+# ------ 12: SETTINGS AND SESSIONS ------
+def m012_settings_sessions(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        id_hash TEXT PRIMARY KEY,
+        user_id INTEGER,
+        created_at TEXT,
+        expires_at TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)")
+
+
+# ------ 13: LOOKUP INDEXES ------
+def m013_lookup_indexes(conn):
+    # users.email is already covered by its UNIQUE constraint's index.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_role_branch ON users (role, branch, name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_assigned_to ON tasks (assigned_to)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_library_branch ON library (branch, id)")
+    conn.execute("ANALYZE")
+
+
+# ------ 14: USER SEARCH INDEX ------
+def m014_user_search_index(conn):
+    # db.search_users() without a branch filter pages through one role
+    # ordered by name.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_role_name ON users (role, name)")
+    conn.execute("ANALYZE users")
+
+
+# ------ 15: COMPLETION COUNTERS ------
+def m015_completion_stats(conn):
+    # Per-task and per-branch completed/on-time/late counters, kept current
+    # by triggers like student_stats, so the Performance page never joins
+    # students with tasks. A task counts towards one branch: its assignee
+    # branch, or the assigned student's current branch.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS task_stats (
+        task_id INTEGER PRIMARY KEY,
+        branch TEXT,
+        deadline TEXT,
+        completed INTEGER DEFAULT 0,
+        on_time INTEGER DEFAULT 0,
+        late INTEGER DEFAULT 0
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_task_stats_deadline ON task_stats (deadline, task_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_task_stats_branch ON task_stats (branch, deadline, task_id)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS branch_stats (
+        branch TEXT PRIMARY KEY,
+        students INTEGER DEFAULT 0,
+        branch_tasks INTEGER DEFAULT 0,
+        student_tasks INTEGER DEFAULT 0,
+        completed INTEGER DEFAULT 0,
+        on_time INTEGER DEFAULT 0,
+        late INTEGER DEFAULT 0
+    ) WITHOUT ROWID
+    """)
+
+    # Roster size per branch
+    student = "INSERT INTO branch_stats (branch, students) VALUES ({b}, 1) " \
+              "ON CONFLICT (branch) DO UPDATE SET students = students + 1;"
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS users_branch_stats_ai AFTER INSERT ON users
+    WHEN new.role = 'student' AND new.branch IS NOT NULL BEGIN
+        {student.format(b="new.branch")}
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS users_branch_stats_ad AFTER DELETE ON users
+    WHEN old.role = 'student' AND old.branch IS NOT NULL BEGIN
+        UPDATE branch_stats SET students = students - 1 WHERE branch = old.branch;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS users_branch_stats_au AFTER UPDATE OF role, branch ON users
+    WHEN old.role IS NOT new.role OR old.branch IS NOT new.branch BEGIN
+        UPDATE branch_stats SET students = students - 1
+        WHERE branch = old.branch AND old.role = 'student';
+        INSERT INTO branch_stats (branch, students)
+        SELECT new.branch, 1 WHERE new.role = 'student' AND new.branch IS NOT NULL
+        ON CONFLICT (branch) DO UPDATE SET students = students + 1;
+    END
+    """)
+
+    # Tasks given to a student move with them to a new branch
+    mine = "SELECT s.* FROM task_stats s JOIN tasks t ON t.id = s.task_id " \
+           "WHERE t.assignee_type = 'student' AND t.assignee_id = new.id"
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS users_task_stats_au AFTER UPDATE OF branch ON users
+    WHEN old.branch IS NOT new.branch BEGIN
+        UPDATE branch_stats SET
+            student_tasks = student_tasks - (SELECT COUNT(*) FROM ({mine})),
+            completed = completed - (SELECT COALESCE(SUM(completed), 0) FROM ({mine})),
+            on_time = on_time - (SELECT COALESCE(SUM(on_time), 0) FROM ({mine})),
+            late = late - (SELECT COALESCE(SUM(late), 0) FROM ({mine}))
+        WHERE branch = old.branch;
+        UPDATE task_stats SET branch = new.branch
+        WHERE task_id IN (SELECT task_id FROM ({mine}));
+        INSERT INTO branch_stats (branch, student_tasks, completed, on_time, late)
+        SELECT new.branch, COUNT(*), SUM(completed), SUM(on_time), SUM(late) FROM ({mine})
+        WHERE new.branch IS NOT NULL
+        GROUP BY 1 HAVING COUNT(*) > 0
+        ON CONFLICT (branch) DO UPDATE SET
+            student_tasks = student_tasks + excluded.student_tasks,
+            completed = completed + excluded.completed,
+            on_time = on_time + excluded.on_time,
+            late = late + excluded.late;
+    END
+    """)
+
+    # Tasks
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_stats_ai AFTER INSERT ON tasks BEGIN
+        INSERT INTO task_stats (task_id, branch, deadline)
+        VALUES (new.id,
+                CASE WHEN new.assignee_type = 'branch' THEN new.assignee_branch
+                     ELSE (SELECT branch FROM users WHERE id = new.assignee_id) END,
+                new.deadline);
+        INSERT INTO branch_stats (branch, branch_tasks, student_tasks)
+        SELECT branch, new.assignee_type = 'branch', new.assignee_type = 'student'
+        FROM task_stats WHERE task_id = new.id AND branch IS NOT NULL
+        ON CONFLICT (branch) DO UPDATE SET
+            branch_tasks = branch_tasks + excluded.branch_tasks,
+            student_tasks = student_tasks + excluded.student_tasks;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_stats_ad AFTER DELETE ON tasks BEGIN
+        UPDATE branch_stats SET
+            branch_tasks = branch_tasks - (old.assignee_type = 'branch'),
+            student_tasks = student_tasks - (old.assignee_type = 'student'),
+            completed = completed - (SELECT completed FROM task_stats WHERE task_id = old.id),
+            on_time = on_time - (SELECT on_time FROM task_stats WHERE task_id = old.id),
+            late = late - (SELECT late FROM task_stats WHERE task_id = old.id)
+        WHERE branch = (SELECT branch FROM task_stats WHERE task_id = old.id);
+        DELETE FROM task_stats WHERE task_id = old.id;
+    END
+    """)
+    # A new deadline re-sorts the task's completions into on time / late
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_stats_au AFTER UPDATE OF deadline ON tasks
+    WHEN old.deadline IS NOT new.deadline BEGIN
+        UPDATE branch_stats SET
+            on_time = on_time - (SELECT on_time FROM task_stats WHERE task_id = new.id),
+            late = late - (SELECT late FROM task_stats WHERE task_id = new.id)
+        WHERE branch = (SELECT branch FROM task_stats WHERE task_id = new.id);
+        UPDATE task_stats SET
+            deadline = new.deadline,
+            on_time = (SELECT COUNT(*) FROM completed
+                       WHERE task_id = new.id AND substr(completed_at, 1, 10) <= new.deadline),
+            late = (SELECT COUNT(*) FROM completed
+                    WHERE task_id = new.id AND substr(completed_at, 1, 10) > new.deadline)
+        WHERE task_id = new.id;
+        UPDATE branch_stats SET
+            on_time = on_time + (SELECT on_time FROM task_stats WHERE task_id = new.id),
+            late = late + (SELECT late FROM task_stats WHERE task_id = new.id)
+        WHERE branch = (SELECT branch FROM task_stats WHERE task_id = new.id);
+    END
+    """)
+
+    # Completions; legacy rows without a timestamp are neither on time nor late
+    for event, suffix, row, sign in (("INSERT", "ai", "new", "+"), ("DELETE", "ad", "old", "-")):
+        on_time = f"COALESCE(substr({row}.completed_at, 1, 10) <= deadline, 0)"
+        late = f"COALESCE(substr({row}.completed_at, 1, 10) > deadline, 0)"
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS completed_task_stats_{suffix}
+        AFTER {event} ON completed BEGIN
+            UPDATE branch_stats SET
+                completed = completed {sign} 1,
+                on_time = on_time {sign} (SELECT {on_time} FROM task_stats WHERE task_id = {row}.task_id),
+                late = late {sign} (SELECT {late} FROM task_stats WHERE task_id = {row}.task_id)
+            WHERE branch = (SELECT branch FROM task_stats WHERE task_id = {row}.task_id);
+            UPDATE task_stats SET
+                completed = completed {sign} 1,
+                on_time = on_time {sign} {on_time},
+                late = late {sign} {late}
+            WHERE task_id = {row}.task_id;
+        END
+        """)
+
+    rebuild_completion_stats(conn)
+
+
+def rebuild_completion_stats(conn):
+    conn.execute("DELETE FROM task_stats")
+    conn.execute("DELETE FROM branch_stats")
+    conn.execute("""
+        INSERT INTO task_stats (task_id, branch, deadline, completed, on_time, late)
+        SELECT t.id,
+               CASE WHEN t.assignee_type = 'branch' THEN t.assignee_branch ELSE u.branch END,
+               t.deadline,
+               (SELECT COUNT(*) FROM completed c WHERE c.task_id = t.id),
+               (SELECT COUNT(*) FROM completed c
+                WHERE c.task_id = t.id AND substr(c.completed_at, 1, 10) <= t.deadline),
+               (SELECT COUNT(*) FROM completed c
+                WHERE c.task_id = t.id AND substr(c.completed_at, 1, 10) > t.deadline)
+        FROM tasks t
+        LEFT JOIN users u ON t.assignee_type = 'student' AND u.id = t.assignee_id
+    """)
+    conn.execute("""
+        INSERT INTO branch_stats (branch, students, branch_tasks, student_tasks, completed, on_time, late)
+        SELECT branch, SUM(students), SUM(branch_tasks), SUM(student_tasks),
+               SUM(completed), SUM(on_time), SUM(late)
+        FROM (
+            SELECT branch, COUNT(*) AS students, 0 AS branch_tasks, 0 AS student_tasks,
+                   0 AS completed, 0 AS on_time, 0 AS late
+            FROM users WHERE role = 'student' AND branch IS NOT NULL GROUP BY branch
+            UNION ALL
+            SELECT s.branch, 0, SUM(t.assignee_type = 'branch'), SUM(t.assignee_type = 'student'),
+                   SUM(s.completed), SUM(s.on_time), SUM(s.late)
+            FROM task_stats s JOIN tasks t ON t.id = s.task_id
+            WHERE s.branch IS NOT NULL GROUP BY s.branch
+        )
+        GROUP BY branch
+    """)
+
+
+# ------ 16: OUTBOX LEASES ------
+def m016_outbox_leases(conn):
+    # A claim expires after mailer.LEASE; rows still 'sending' past it
+    # belong to a dispatcher that died and can be claimed again.
+    _add_column(conn, "outbox", "claimed_at", "TEXT")
+
+
+MIGRATIONS = [
+    (1, m001_base_tables),
+    (2, m002_task_assignees),
+    (3, m003_attendance_unique),
+    (4, m004_library_file_size),
+    (5, m005_library_fts),
+    (6, m006_ingest_jobs),
+    (7, m007_outbox),
+    (8, m008_report_summaries),
+    (9, m009_completed_unique),
+    (10, m010_submissions),
+    (11, m011_blob_refs),
+    (12, m012_settings_sessions),
+    (13, m013_lookup_indexes),
+    (14, m014_user_search_index),
+    (15, m015_completion_stats),
+    (16, m016_outbox_leases),
+]
+
+
+def current_version(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TEXT
+    )
+    """)
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate(conn):
+    if current_version(conn) >= MIGRATIONS[-1][0]:
+        return []
+
+    applied = []
+    for version, fn in MIGRATIONS:
+        # IMMEDIATE takes the write lock up front, so when several processes
+        # start together only one applies each step; the rest see it done.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if current_version(conn) < version:
+                fn(conn)
+                conn.execute(
+                    "INSERT INTO schema_version (version, name, applied_at) VALUES (?,?,?)",
+                    (version, fn.__name__, datetime.now().isoformat())
+                )
+                applied.append(fn.__name__)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return applied
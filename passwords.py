@@ -0,0 +1,86 @@
+import base64
+import hashlib
+import hmac
+import os
+
+# Salted password hashing with hashlib.scrypt (or PBKDF2 when configured).
+# Stored format: "scrypt$n$r$p$salt$hash" / "pbkdf2_sha256$iterations$salt$hash".
+# Older rows hold a bare unsalted SHA-256 hex digest; they still verify and
+# are re-hashed on the next successful login.
+SCHEME = os.environ.get("PLANNER_PASSWORD_SCHEME", "scrypt")
+SCRYPT_N = int(os.environ.get("PLANNER_SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(os.environ.get("PLANNER_SCRYPT_R", "8"))
+SCRYPT_P = int(os.environ.get("PLANNER_SCRYPT_P", "1"))
+PBKDF2_ITERATIONS = int(os.environ.get("PLANNER_PBKDF2_ITERATIONS", "600000"))
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode()
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=256 * n * r * p + (1 << 20), dklen=HASH_BYTES
+    )
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations, HASH_BYTES)
+
+
+def hash_password(password: str, scheme=None, cost=None):
+    scheme = scheme or SCHEME
+    salt = os.urandom(SALT_BYTES)
+    if scheme == "scrypt":
+        n = cost or SCRYPT_N
+        return f"scrypt${n}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(_scrypt(password, salt, n, SCRYPT_R, SCRYPT_P))}"
+    if scheme == "pbkdf2_sha256":
+        iterations = cost or PBKDF2_ITERATIONS
+        return f"pbkdf2_sha256${iterations}${_b64(salt)}${_b64(_pbkdf2(password, salt, iterations))}"
+    raise ValueError(f"Unknown password scheme: {scheme}")
+
+
+def verify_password(password: str, stored):
+    if not stored:
+        return False
+    parts = stored.split("$")
+    try:
+        if parts[0] == "scrypt" and len(parts) == 6:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            expected = base64.b64decode(parts[5])
+            actual = _scrypt(password, base64.b64decode(parts[4]), n, r, p)
+        elif parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+            expected = base64.b64decode(parts[3])
+            actual = _pbkdf2(password, base64.b64decode(parts[2]), int(parts[1]))
+        elif len(stored) == 64:
+            expected = stored.encode()
+            actual = hashlib.sha256(password.encode()).hexdigest().encode()
+        else:
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+def needs_rehash(stored):
+    parts = stored.split("$")
+    if parts[0] != SCHEME:
+        return True
+    if SCHEME == "scrypt":
+        return parts[1:4] != [str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+    return parts[1] != str(PBKDF2_ITERATIONS)
+
+
+# Verified against when the email is unknown, so a failed login costs the
+# same whether or not the account exists.
+_DUMMY_HASH = None
+
+
+def dummy_verify(password):
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        _DUMMY_HASH = hash_password("dummy password")
+    verify_password(password, _DUMMY_HASH)
@@ -0,0 +1,21 @@
+# Text extraction helpers run inside the ingestion process pool. Kept free of
+# db/streamlit imports so worker processes start quickly.
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+
+def _reader(path):
+    if PdfReader is None:
+        raise RuntimeError("pypdf is not installed")
+    return PdfReader(path)
+
+
+def count_pages(path):
+    return len(_reader(path).pages)
+
+
+def extract_pages(path, start, stop):
+    reader = _reader(path)
+    return [(reader.pages[i].extract_text() or "") for i in range(start, stop)]
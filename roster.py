@@ -0,0 +1,207 @@
+import csv
+import io
+import multiprocessing
+import os
+import re
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+import passwords
+from db import (
+    existing_emails, insert_users,
+    iter_users, iter_attendance, iter_performance,
+    USER_EXPORT_COLUMNS, ATTENDANCE_EXPORT_COLUMNS, PERFORMANCE_EXPORT_COLUMNS,
+)
+
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
+
+# Bulk roster import (CSV or XLSX) and streaming CSV exports. Rows are
+# read, validated and inserted a chunk at a time, so memory stays flat for
+# any file size; password hashing for a chunk is spread over a process
+# pool since it dominates the cost.
+CHUNK_SIZE = 500
+HASH_WORKERS = int(os.environ.get("PLANNER_HASH_WORKERS", str(os.cpu_count() or 2)))
+EXPORT_ROOT = "exports"
+EXPORT_KEEP_SECONDS = 6 * 3600  # matches fileserver.LINK_TTL
+
+ROLES = ("student", "teacher")
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+GENERATED_PASSWORD_BYTES = 9
+
+
+# ------ READING ------
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))  # phone numbers typed into Excel
+    return str(value).strip()
+
+
+def _header(values):
+    return [_cell(v).lower().replace(" ", "_") for v in values]
+
+
+def _read_csv(fileobj):
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    reader = csv.reader(text)
+    header = _header(next(reader, []))
+    for line, values in enumerate(reader, start=2):
+        if any(v.strip() for v in values):
+            yield line, dict(zip(header, (v.strip() for v in values)))
+
+
+def _read_xlsx(fileobj):
+    if load_workbook is None:
+        raise RuntimeError("openpyxl is not installed")
+    workbook = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = _header(next(rows, ()))
+        for line, values in enumerate(rows, start=2):
+            if any(v not in (None, "") for v in values):
+                yield line, dict(zip(header, map(_cell, values)))
+    finally:
+        workbook.close()
+
+
+def read_rows(fileobj, file_name):
+    if file_name.lower().endswith((".xlsx", ".xlsm")):
+        return _read_xlsx(fileobj)
+    return _read_csv(fileobj)
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# ------ IMPORT ------
+def validate(row, branches=None, default_role="student"):
+    # Returns (name, email, role, branch, phone, dob, password) or raises
+    # ValueError with a message for the admin.
+    name, email = row.get("name", ""), row.get("email", "")
+    role = (row.get("role") or default_role).lower()
+    branch = row.get("branch") or None
+    if not name:
+        raise ValueError("name is missing")
+    if not EMAIL_RE.fullmatch(email):
+        raise ValueError(f"invalid email {email!r}")
+    if role not in ROLES:
+        raise ValueError(f"unknown role {role!r}")
+    if role == "student" and not branch:
+        raise ValueError("branch is missing")
+    if branch and branches and branch not in branches:
+        raise ValueError(f"unknown branch {branch!r}")
+    dob = row.get("dob") or None
+    if dob:
+        try:
+            date.fromisoformat(dob)
+        except ValueError:
+            raise ValueError(f"date of birth {dob!r} is not YYYY-MM-DD") from None
+    return name, email, role, branch, row.get("phone") or None, dob, row.get("password") or None
+
+
+def import_roster(fileobj, file_name, branches=None, default_role="student", progress=None):
+    # Returns counts, per-line errors and the passwords generated for rows
+    # without one (shown to the admin once, never stored in clear).
+    result = {"read": 0, "inserted": 0, "skipped": 0, "errors": [], "credentials": []}
+    seen = set()
+
+    pool = ProcessPoolExecutor(
+        max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+    with pool:
+        for chunk in _chunks(read_rows(fileobj, file_name), CHUNK_SIZE):
+            result["read"] += len(chunk)
+            valid = []
+            for line, row in chunk:
+                try:
+                    user = validate(row, branches, default_role)
+                except ValueError as e:
+                    result["errors"].append({"line": line, "email": row.get("email"), "error": str(e)})
+                    continue
+                if user[1] in seen:
+                    result["errors"].append({"line": line, "email": user[1],
+                                             "error": "duplicate email in file"})
+                    continue
+                seen.add(user[1])
+                valid.append(user)
+
+            existing = existing_emails(u[1] for u in valid)
+            result["skipped"] += len(existing)
+            valid = [u for u in valid if u[1] not in existing]
+
+            plain = []
+            for name, email, role, branch, phone, dob, password in valid:
+                if not password:
+                    password = secrets.token_urlsafe(GENERATED_PASSWORD_BYTES)
+                    result["credentials"].append((email, password))
+                plain.append(password)
+            hashes = pool.map(passwords.hash_password, plain,
+                              chunksize=max(1, len(plain) // (HASH_WORKERS * 4)))
+
+            rows = [(name, email, hashed, role, branch, phone, dob)
+                    for (name, email, role, branch, phone, dob, _), hashed in zip(valid, hashes)]
+            inserted = insert_users(rows) if rows else 0
+            result["inserted"] += inserted
+            result["skipped"] += len(rows) - inserted  # registered meanwhile
+
+            if progress:
+                progress(result)
+    return result
+
+
+def credentials_csv(credentials):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(("email", "password"))
+    writer.writerows(credentials)
+    return out.getvalue()
+
+
+# ------ EXPORT ------
+EXPORTS = {
+    "users": (USER_EXPORT_COLUMNS, iter_users),
+    "attendance": (ATTENDANCE_EXPORT_COLUMNS, iter_attendance),
+    "performance": (PERFORMANCE_EXPORT_COLUMNS, iter_performance),
+}
+
+
+def export_csv(kind, out, **filters):
+    # Writes rows to `out` as they are read from the database.
+    columns, rows = EXPORTS[kind]
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    count = 0
+    for row in rows(**filters):
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def export_file(kind, **filters):
+    os.makedirs(EXPORT_ROOT, exist_ok=True)
+    for name in os.listdir(EXPORT_ROOT):
+        old = os.path.join(EXPORT_ROOT, name)
+        if time.time() - os.path.getmtime(old) > EXPORT_KEEP_SECONDS:
+            os.unlink(old)
+    path = os.path.join(EXPORT_ROOT, f"{kind}-{datetime.now():%Y%m%d-%H%M%S}-{secrets.token_hex(4)}.csv")
+    with open(path, "w", newline="", encoding="utf-8") as out:
+        export_csv(kind, out, **filters)
+    return path
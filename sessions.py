@@ -0,0 +1,121 @@
+import hashlib
+import hmac
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import cache
+from db import get_secret, create_session, rotate_session_row, get_session_user, delete_session
+
+# Signed, expiring login tokens. A token is "<id>.<expiry>.<signature>";
+# the signature and expiry are checked before touching the database, and
+# only a hash of the id is stored. Active sessions are kept in an in-memory
+# LRU so a browser refresh or reconnect restores the user without a query.
+#
+# The browser keeps the token in a cookie (never the URL) and gets a new
+# one each time it resumes, so the lifetime is a sliding window.
+SESSION_TTL = timedelta(hours=12)
+COOKIE_NAME = "planner_session"
+# A replaced token keeps working this long, for other tabs opened with it.
+ROTATE_GRACE = timedelta(seconds=60)
+LRU_SIZE = 4096
+# Cached sessions are re-checked against the table this often, so a logout
+# in another process takes effect here too.
+RECHECK_SECONDS = 300
+
+SIGNATURE_RE = re.compile(r"[0-9a-f]{32}")
+
+_lock = threading.Lock()
+_lru = OrderedDict()
+
+
+def _sign(body):
+    key = get_secret("sessions").encode()
+    return hmac.new(key, body.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def _id_hash(sid):
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+
+def _remember(id_hash, user, expires):
+    with _lock:
+        _lru[id_hash] = (user, expires, cache.generation("users"), time.time())
+        _lru.move_to_end(id_hash)
+        while len(_lru) > LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+def _new_token():
+    sid = secrets.token_urlsafe(24)
+    expires = datetime.now() + SESSION_TTL
+    body = f"{sid}.{int(expires.timestamp())}"
+    return _id_hash(sid), expires, f"{body}.{_sign(body)}"
+
+
+def start_session(user):
+    id_hash, expires, token = _new_token()
+    create_session(id_hash, user["id"], expires)
+    _remember(id_hash, _public(user), expires.timestamp())
+    return token
+
+
+def rotate_session(token, user):
+    # Call after resume_session() succeeded with token.
+    old_hash = _id_hash(token.split(".")[0])
+    id_hash, expires, new_token = _new_token()
+    rotate_session_row(old_hash, id_hash, user["id"], expires, datetime.now() + ROTATE_GRACE)
+    with _lock:
+        _lru.pop(old_hash, None)
+    _remember(id_hash, _public(user), expires.timestamp())
+    return new_token
+
+
+def resume_session(token):
+    try:
+        sid, exp, sig = token.split(".")
+        expires = int(exp)
+    except (AttributeError, ValueError):
+        return None
+    # Cookies are client input: compare_digest() raises on non-ASCII str
+    if not SIGNATURE_RE.fullmatch(sig) or expires < time.time():
+        return None
+    if not hmac.compare_digest(sig, _sign(f"{sid}.{exp}")):
+        return None
+
+    id_hash = _id_hash(sid)
+    with _lock:
+        entry = _lru.get(id_hash)
+        now = time.time()
+        if (entry and entry[1] > now and entry[2] == cache.generation("users")
+                and now - entry[3] < RECHECK_SECONDS):
+            _lru.move_to_end(id_hash)
+            return dict(entry[0])
+
+    user = get_session_user(id_hash)
+    if user is None:
+        with _lock:
+            _lru.pop(id_hash, None)
+        return None
+    # The row's expiry is earlier than the token's once it was rotated
+    row_expires = datetime.fromisoformat(user.pop("session_expires_at")).timestamp()
+    user = _public(user)
+    _remember(id_hash, user, min(expires, row_expires))
+    return dict(user)
+
+
+def end_session(token):
+    sid = (token or "").split(".")[0]
+    if not sid:
+        return
+    id_hash = _id_hash(sid)
+    with _lock:
+        _lru.pop(id_hash, None)
+    delete_session(id_hash)
+
+
+def _public(user):
+    return {k: v for k, v in user.items() if k != "password"}
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+import instrument
+
+# Opt-in slow-query log. With PLANNER_SLOW_QUERY_MS set, every pooled
+# connection gets a trace callback (statement text with bound values) and
+# a progress handler (counts SQLite VM steps). Statements slower than the
+# threshold are written as JSON lines, with their EXPLAIN QUERY PLAN, to a
+# rotating log and aggregated per normalized statement:
+#
+#   PLANNER_SLOW_QUERY_MS=20 streamlit run app.py
+#   python manage.py slow-queries
+THRESHOLD_MS = float(os.environ.get("PLANNER_SLOW_QUERY_MS", "0"))
+LOG_PATH = os.environ.get("PLANNER_SLOW_QUERY_LOG", "slow_queries.log")
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+PROGRESS_STEPS = 1000
+
+_lock = threading.Lock()
+_stats = {}
+_plans = {}
+_logger = None
+
+
+def enabled():
+    return THRESHOLD_MS > 0
+
+
+def _get_logger():
+    global _logger
+    with _lock:
+        if _logger is None:
+            logger = logging.getLogger("planner.slowquery")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            handler = RotatingFileHandler(LOG_PATH, maxBytes=LOG_MAX_BYTES,
+                                          backupCount=LOG_BACKUPS, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            _logger = logger
+        return _logger
+
+
+def attach(conn):
+    # conn must be an instrument.TimedConnection
+    state = {"steps": 0, "text": None}
+
+    def trace(text):
+        state["text"] = text
+
+    def progress():
+        state["steps"] += 1
+        return 0
+
+    def before(conn):
+        state["steps"] = 0
+        state["text"] = None
+
+    def after(conn, sql, parameters, ms, rows):
+        if ms >= THRESHOLD_MS:
+            _observe(conn, sql, parameters, ms, rows,
+                     state["steps"] * PROGRESS_STEPS, state["text"])
+
+    conn.set_trace_callback(trace)
+    conn.set_progress_handler(progress, PROGRESS_STEPS)
+    conn.before_statement = before
+    conn.after_statement = after
+
+
+def explain(conn, sql, parameters=()):
+    # Bypasses the timed execute() so the plan lookup is not itself logged.
+    try:
+        rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return None
+    return [r[3] for r in rows]
+
+
+def full_scans(plan):
+    # "SCAN t" reads every row of t; "SEARCH" goes through an index. Scans
+    # of CTEs and subqueries SQLite already built, and of the FTS table,
+    # are not table scans.
+    plan = plan or []
+    derived = {d.split()[1] for d in plan if d.startswith(("MATERIALIZE ", "CO-ROUTINE "))}
+    return [d for d in plan if d.startswith("SCAN ")
+            and " VIRTUAL TABLE" not in d
+            and d.split()[1] not in derived | {"CONSTANT"}]
+
+
+def _observe(conn, sql, parameters, ms, rows, steps, text):
+    statement = instrument.normalize_sql(sql)
+    if statement not in _plans:
+        if isinstance(parameters, list) and parameters and isinstance(parameters[0], (tuple, list, dict)):
+            parameters = parameters[0]  # executemany(): any one row gives the plan
+        if isinstance(parameters, (tuple, list, dict)):
+            _plans[statement] = explain(conn, sql, parameters)
+    plan = _plans.get(statement)
+    scans = full_scans(plan)
+
+    with _lock:
+        s = _stats.setdefault(statement, {
+            "statement": statement, "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "max_vm_steps": 0, "plan": plan, "full_scans": scans, "example": None,
+        })
+        s["count"] += 1
+        s["total_ms"] += ms
+        s["max_vm_steps"] = max(s["max_vm_steps"], steps)
+        if ms >= s["max_ms"]:
+            s["max_ms"] = ms
+            s["example"] = text
+
+    _get_logger().info(json.dumps({
+        "at": datetime.now().isoformat(timespec="milliseconds"),
+        "ms": round(ms, 2),
+        "vm_steps": steps,
+        "rows": rows,
+        "statement": statement,
+        "sql": text,
+        "plan": plan,
+        "full_scans": scans,
+    }))
+
+
+def report():
+    with _lock:
+        rows = [dict(s, total_ms=round(s["total_ms"], 1), max_ms=round(s["max_ms"], 1))
+                for s in _stats.values()]
+    rows.sort(key=lambda r: r["total_ms"], reverse=True)
+    return rows
+
+
+def read_log(path=LOG_PATH):
+    # Aggregates the log (and its rotated files) across every process that
+    # wrote to it.
+    stats = {}
+    for name in [f"{path}.{i}" for i in range(LOG_BACKUPS, 0, -1)] + [path]:
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                s = stats.setdefault(entry["statement"], {
+                    "statement": entry["statement"], "count": 0, "total_ms": 0.0,
+                    "max_ms": 0.0, "full_scans": entry.get("full_scans") or [],
+                })
+                s["count"] += 1
+                s["total_ms"] += entry["ms"]
+                s["max_ms"] = max(s["max_ms"], entry["ms"])
+    rows = list(stats.values())
+    rows.sort(key=lambda r: r["total_ms"], reverse=True)
+    return rows
@@ -0,0 +1,72 @@
+import hashlib
+import os
+import tempfile
+import time
+
+import instrument
+
+# Content-addressed storage for uploads. Files live at
+# blobs/<sha[:2]>/<sha[2:4]>/<sha256>, so identical uploads share one copy.
+# Reference counts are kept in the blobs table (see db.py).
+BLOB_ROOT = "blobs"
+CHUNK_SIZE = 1024 * 1024
+
+# A blob written or re-used within this window is never collected, which
+# covers the gap between storing a file and inserting the row that uses it.
+GC_GRACE_SECONDS = 60
+
+
+def blob_path(sha):
+    return os.path.join(BLOB_ROOT, sha[:2], sha[2:4], sha)
+
+
+def _write_hashed(src, folder):
+    os.makedirs(folder, exist_ok=True)
+    digest, size = hashlib.sha256(), 0
+
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while chunk := src.read(CHUNK_SIZE):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return tmp, size, digest.hexdigest()
+
+
+def put_stream(src):
+    tmp, size, sha = _write_hashed(src, os.path.join(BLOB_ROOT, "tmp"))
+    path = blob_path(sha)
+
+    if os.path.exists(path):
+        os.unlink(tmp)
+        os.utime(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+    return sha, size, path
+
+
+def remove_blob(sha):
+    path = blob_path(sha)
+    try:
+        if time.time() - os.path.getmtime(path) < GC_GRACE_SECONDS:
+            return False
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        digest = hashlib.sha256()
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return os.path.getsize(path), digest.hexdigest()
+
+
+instrument.instrument_module(globals(), "io", skip={"blob_path"})
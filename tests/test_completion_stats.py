@@ -0,0 +1,127 @@
+import random
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+import migrations
+
+# The task_stats / branch_stats counters (migration 15) are kept by
+# triggers; after any mix of writes they must equal a full rebuild.
+BRANCHES = ["B1", "B2", "B3", "B4"]
+START = date(2026, 1, 1)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(tmp_path / "planner.db")
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def _day(rng):
+    return (START + timedelta(days=rng.randrange(60))).isoformat()
+
+
+def _snapshot(conn):
+    return (
+        conn.execute("SELECT * FROM task_stats ORDER BY task_id").fetchall(),
+        conn.execute("""
+            SELECT * FROM branch_stats
+            WHERE students OR branch_tasks OR student_tasks OR completed
+            ORDER BY branch
+        """).fetchall(),
+    )
+
+
+def _ids(conn, sql):
+    return [r[0] for r in conn.execute(sql)]
+
+
+def _add_task(conn, rng):
+    if rng.random() < 0.6:
+        branch = rng.choice(BRANCHES)
+        conn.execute(
+            """INSERT INTO tasks (title, deadline, assigned_to, assignee_type, assignee_branch)
+               VALUES ('t', ?, ?, 'branch', ?)""",
+            (_day(rng), f"branch:{branch}", branch)
+        )
+    else:
+        student = rng.choice(_ids(conn, "SELECT id FROM users WHERE role='student'"))
+        conn.execute(
+            """INSERT INTO tasks (title, deadline, assigned_to, assignee_type, assignee_id)
+               VALUES ('t', ?, ?, 'student', ?)""",
+            (_day(rng), f"student:{student}", student)
+        )
+
+
+def _random_write(conn, rng):
+    students = _ids(conn, "SELECT id FROM users WHERE role='student'")
+    tasks = _ids(conn, "SELECT id FROM tasks")
+    op = rng.random()
+    if op < 0.35:
+        completed_at = None if rng.random() < 0.1 else _day(rng) + "T12:00:00"
+        conn.execute(
+            "INSERT OR IGNORE INTO completed (student_id, task_id, completed_at) VALUES (?,?,?)",
+            (rng.choice(students), rng.choice(tasks), completed_at)
+        )
+    elif op < 0.45:
+        conn.execute("DELETE FROM completed WHERE id = (SELECT id FROM completed ORDER BY random() LIMIT 1)")
+    elif op < 0.55:
+        conn.execute("UPDATE tasks SET deadline=? WHERE id=?", (_day(rng), rng.choice(tasks)))
+    elif op < 0.65:
+        _add_task(conn, rng)
+    elif op < 0.7:
+        conn.execute("DELETE FROM tasks WHERE id=?", (rng.choice(tasks),))
+    elif op < 0.82:
+        branch = None if rng.random() < 0.1 else rng.choice(BRANCHES + ["B5"])
+        conn.execute("UPDATE users SET branch=? WHERE id=?", (branch, rng.choice(students)))
+    elif op < 0.88:
+        conn.execute("UPDATE users SET role='teacher' WHERE id=?", (rng.choice(students),))
+    else:
+        conn.execute(
+            "INSERT INTO users (name, email, password, role, branch) VALUES ('s', ?, 'x', 'student', ?)",
+            (f"s{rng.random()}@example.com", rng.choice(BRANCHES))
+        )
+    conn.commit()
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3, 4])
+def test_counters_match_rebuild(conn, seed):
+    rng = random.Random(seed)
+    for i in range(40):
+        conn.execute(
+            "INSERT INTO users (name, email, password, role, branch) VALUES (?, ?, 'x', 'student', ?)",
+            (f"s{i}", f"s{i}@example.com", rng.choice(BRANCHES))
+        )
+    for _ in range(20):
+        _add_task(conn, rng)
+    conn.commit()
+
+    for step in range(400):
+        _random_write(conn, rng)
+        if step % 50 == 49:
+            maintained = _snapshot(conn)
+            with conn:
+                migrations.rebuild_completion_stats(conn)
+            assert _snapshot(conn) == maintained, f"diverged by step {step}"
+
+
+def test_on_time_and_late_follow_the_deadline(conn):
+    conn.execute("INSERT INTO users (name, email, password, role, branch) VALUES ('a', 'a@x', 'x', 'student', 'B1')")
+    conn.execute("INSERT INTO users (name, email, password, role, branch) VALUES ('b', 'b@x', 'x', 'student', 'B1')")
+    conn.execute("""INSERT INTO tasks (title, deadline, assigned_to, assignee_type, assignee_branch)
+                    VALUES ('t', '2026-01-10', 'branch:B1', 'branch', 'B1')""")
+    conn.execute("INSERT INTO completed (student_id, task_id, completed_at) VALUES (1, 1, '2026-01-10T23:00:00')")
+    conn.execute("INSERT INTO completed (student_id, task_id, completed_at) VALUES (2, 1, '2026-01-11T08:00:00')")
+    conn.commit()
+
+    stats = "SELECT completed, on_time, late FROM {} WHERE {}"
+    assert conn.execute(stats.format("task_stats", "task_id=1")).fetchone() == (2, 1, 1)
+    assert conn.execute(stats.format("branch_stats", "branch='B1'")).fetchone() == (2, 1, 1)
+
+    conn.execute("UPDATE tasks SET deadline='2026-01-11' WHERE id=1")
+    conn.commit()
+    assert conn.execute(stats.format("task_stats", "task_id=1")).fetchone() == (2, 2, 0)
+    assert conn.execute("SELECT students, branch_tasks FROM branch_stats WHERE branch='B1'").fetchone() == (2, 1)
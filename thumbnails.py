@@ -0,0 +1,52 @@
+import os
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Profile photos are normalized into a few square JPEG sizes when saved.
+# File names carry the photo's content hash, so a new photo gets a new URL
+# and old thumbnails can be cached by the browser indefinitely.
+THUMB_ROOT = os.path.join("profile_photos", "thumbs")
+SIZES = (48, 140, 256)
+QUALITY = 85
+
+
+def thumb_path(photo_sha, size):
+    return os.path.join(THUMB_ROOT, f"{photo_sha[:16]}-{size}.jpg")
+
+
+def validate_image(fileobj):
+    try:
+        with Image.open(fileobj) as img:
+            img.verify()
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError("Not a valid image file") from e
+    finally:
+        fileobj.seek(0)
+
+
+def make_thumbnails(image_path, photo_sha):
+    os.makedirs(THUMB_ROOT, exist_ok=True)
+    try:
+        with Image.open(image_path) as img:
+            img.draft("RGB", (max(SIZES) * 2, max(SIZES) * 2))
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            for size in SIZES:
+                path = thumb_path(photo_sha, size)
+                if os.path.exists(path):
+                    continue
+                thumb = ImageOps.fit(img, (size, size), Image.LANCZOS)
+                tmp = path + ".part"
+                thumb.save(tmp, "JPEG", quality=QUALITY, optimize=True, progressive=True)
+                os.replace(tmp, path)
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError("Not a valid image file") from e
+
+
+def avatar(user, size=48):
+    # Never touches the original upload; users without thumbnails get None.
+    sha = user.get("photo_sha")
+    if not sha:
+        return None
+    size = min((s for s in SIZES if s >= size), default=max(SIZES))
+    path = thumb_path(sha, size)
+    return path if os.path.exists(path) else None
@@ -0,0 +1,188 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import instrument
+
+# Single writer for the process. Mutations from every Streamlit session are
+# queued and applied by one thread on its own connection, many to a
+# transaction: each operation runs in a SAVEPOINT (so one failure does not
+# undo its neighbours) and the batch is committed once. Callers block on
+# the result, which is only delivered after the commit.
+#
+# A batch is whatever queued up while the previous commit ran, plus
+# anything arriving within FLUSH_MS of its first operation.
+FLUSH_MS = float(os.environ.get("PLANNER_WRITE_FLUSH_MS", "2"))
+MAX_BATCH = int(os.environ.get("PLANNER_WRITE_MAX_BATCH", "256"))
+# Longest a caller waits for its write; a batch waits at most the 5 s busy
+# timeout for the lock, so this only trips if the writer is stuck.
+TIMEOUT_SECONDS = float(os.environ.get("PLANNER_WRITE_TIMEOUT", "60"))
+RESTART_SECONDS = 1
+
+log = logging.getLogger("planner.writer")
+
+_queue = queue.Queue()
+_local = threading.local()
+_start_lock = threading.Lock()
+_thread = None
+_current = []  # batch being applied, failed as a whole if the thread crashes
+_stats_lock = threading.Lock()
+_stats = {"ops": 0, "failed_ops": 0, "batches": 0, "failed_batches": 0,
+          "max_batch": 0, "max_depth": 0, "commit_ms": 0.0, "restarts": 0}
+
+
+def start(connect):
+    # connect() returns a new sqlite3 connection; called once, on the
+    # writer thread.
+    global _thread
+    with _start_lock:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_serve, args=(connect,), name="db-writer", daemon=True)
+        _thread.start()
+
+
+def submit(fn, *args):
+    # fn(conn, *args) runs on the writer thread; it must not commit.
+    future = Future()
+    _queue.put((future, fn, args))
+    depth = _queue.qsize()
+    with _stats_lock:
+        _stats["max_depth"] = max(_stats["max_depth"], depth)
+    return future
+
+
+def run(fn, *args):
+    if threading.current_thread() is _thread:
+        # Called from inside another operation: already in its transaction.
+        return fn(_local.conn, *args)
+    future = submit(fn, *args)
+    try:
+        return future.result(timeout=TIMEOUT_SECONDS)
+    except TimeoutError:
+        future.cancel()  # still queued: make sure it never runs
+        raise
+
+
+def stats():
+    with _stats_lock:
+        batches = _stats["batches"]
+        return dict(
+            _stats,
+            depth=_queue.qsize(),
+            avg_batch=round(_stats["ops"] / batches, 2) if batches else None,
+            avg_commit_ms=round(_stats["commit_ms"] / batches, 3) if batches else None,
+            commit_ms=round(_stats["commit_ms"], 1),
+        )
+
+
+def _collect():
+    batch = [_queue.get()]
+    deadline = time.monotonic() + FLUSH_MS / 1000
+    while len(batch) < MAX_BATCH:
+        try:
+            batch.append(_queue.get_nowait())
+            continue
+        except queue.Empty:
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _serve(connect):
+    # A failure outside a batch's transaction (connect() raising, a closed
+    # connection, a bug) must not leave callers waiting: everything in
+    # flight or queued gets the error, then the writer reconnects.
+    while True:
+        try:
+            _run(connect)
+        except Exception as e:
+            log.exception("db writer failed; restarting in %ss", RESTART_SECONDS)
+            conn = getattr(_local, "conn", None)
+            _local.conn = None
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            _fail_pending(e)
+            with _stats_lock:
+                _stats["restarts"] += 1
+            time.sleep(RESTART_SECONDS)
+
+
+def _fail_pending(error):
+    pending = [op[0] for op in _current]
+    _current.clear()
+    while True:
+        try:
+            future, _, _ = _queue.get_nowait()
+        except queue.Empty:
+            break
+        if future.set_running_or_notify_cancel():
+            pending.append(future)
+    for future in pending:
+        if not future.done():
+            future.set_exception(error)
+
+
+def _run(connect):
+    conn = _local.conn = connect()
+    conn.isolation_level = None  # transactions are managed explicitly below
+
+    while True:
+        batch = [op for op in _collect() if op[0].set_running_or_notify_cancel()]
+        if not batch:
+            continue
+        _current[:] = batch
+        outcomes = []
+        start = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, fn, args in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    result = fn(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    outcomes.append((future, None, e))
+                else:
+                    conn.execute("RELEASE op")
+                    outcomes.append((future, result, None))
+            conn.execute("COMMIT")
+        except Exception as e:
+            # BEGIN or COMMIT failed (e.g. the lock stayed busy past the
+            # timeout); nothing in the batch was written.
+            if conn.in_transaction:
+                conn.rollback()
+            outcomes = [(future, None, e) for future, _, _ in batch]
+            failed_batch = True
+        else:
+            failed_batch = False
+        ms = (time.perf_counter() - start) * 1000
+
+        instrument.record("writer", "batch", ms, len(batch), failed_batch)
+        with _stats_lock:
+            _stats["batches"] += 1
+            _stats["failed_batches"] += failed_batch
+            _stats["ops"] += len(batch)
+            _stats["failed_ops"] += sum(1 for _, _, e in outcomes if e is not None)
+            _stats["max_batch"] = max(_stats["max_batch"], len(batch))
+            _stats["commit_ms"] += ms
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        _current.clear()